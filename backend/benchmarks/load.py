@@ -0,0 +1,219 @@
+"""
+Load benchmark for the Trivia API.
+
+Seeds a synthetic question bank into a throwaway database, drives the main
+endpoints with concurrent clients and reports p50/p95/p99 latency and
+requests per second per scenario. Results can be saved as a baseline and
+later runs compared against it; the run fails if a scenario's p95 regresses
+by more than --tolerance.
+
+Run from the backend directory:
+
+    python -m benchmarks.load --rows 100000 --concurrency 8 --requests 2000
+    python -m benchmarks.load --save-baseline benchmarks/baseline.json
+    python -m benchmarks.load --baseline benchmarks/baseline.json
+
+By default the bank goes into a temporary SQLite file. Pass --database with
+the URL of a disposable Postgres database to benchmark against Postgres; its
+tables are dropped and recreated by the migrations. Pass --url to drive an
+already running server over HTTP instead of the in-process test client.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+CATEGORIES = ["Science", "Art", "Geography", "History", "Entertainment", "Sports"]
+SUBJECTS = ["river", "painter", "planet", "battle", "film", "team", "element", "city", "novel", "record"]
+VERBS = ["discovered", "painted", "crossed", "won", "directed", "named", "built", "wrote", "broke", "founded"]
+
+def synthetic_questions(rows, rng):
+    for i in range(rows):
+        subject = rng.choice(SUBJECTS)
+        verb = rng.choice(VERBS)
+        yield {
+            'question': "Which {} was {} in entry {}?".format(subject, verb, i),
+            'answer': "{} {}".format(subject.title(), i),
+            'category': rng.randint(1, len(CATEGORIES)),
+            'difficulty': rng.randint(1, 5)
+        }
+
+def seed(app, rows, rng):
+    from flask_migrate import upgrade
+    from models import db, Category
+    from flaskr.bulk import import_questions
+
+    with app.app_context():
+        # Built by the migrations, like a deployed database, so search has its index
+        db.drop_all()
+        for table in ("questions_fts", "alembic_version"):
+            db.session.execute("DROP TABLE IF EXISTS {}".format(table))
+        db.session.commit()
+        upgrade()
+        for name in CATEGORIES:
+            db.session.add(Category(type=name))
+        db.session.commit()
+
+        started = time.perf_counter()
+        stats = import_questions(synthetic_questions(rows, rng), chunk_size=10000)
+        print("seeded {} questions in {:.1f}s".format(stats.rows, time.perf_counter() - started), file=sys.stderr)
+
+"""
+Scenarios: each returns (method, path, json body) for one request.
+"""
+def list_questions(rng, rows):
+    return "GET", "/questions?page={}".format(rng.randint(1, max(rows // 10, 1))), None
+
+def search_questions(rng, rows):
+    return "POST", "/questions/search", {'searchTerm': "{} {}".format(rng.choice(SUBJECTS), rng.choice(VERBS))}
+
+def category_questions(rng, rows):
+    return "GET", "/categories/{}/questions".format(rng.randint(1, len(CATEGORIES))), None
+
+def quiz(rng, rows):
+    previous = [rng.randint(1, rows) for _ in range(rng.randint(0, 20))]
+    category = rng.randint(0, len(CATEGORIES))
+    return "POST", "/quizzes", {'quiz_category': {'id': category}, 'previous_questions': previous}
+
+SCENARIOS = {
+    'questions': list_questions,
+    'search': search_questions,
+    'category': category_questions,
+    'quiz': quiz,
+}
+
+class TestClientDriver:
+    """Sends requests in-process through a fresh Flask test client per request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def send(self, method, path, body):
+        client = self.app.test_client()
+        response = client.open(path, method=method, json=body)
+        return response.status_code
+
+class HttpDriver:
+    """Sends requests to a running server."""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def send(self, method, path, body):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method)
+        if data is not None:
+            request.add_header("Content-Type", "application/json")
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of sorted samples."""
+    if not samples:
+        return 0.0
+    rank = max(int(round(fraction * len(samples) + 0.5)) - 1, 0)
+    return samples[min(rank, len(samples) - 1)]
+
+def run_scenario(driver, scenario, requests, concurrency, rows, seed_value):
+    rng = random.Random(seed_value)
+    calls = [scenario(rng, rows) for _ in range(requests)]
+
+    def timed_call(call):
+        started = time.perf_counter()
+        status = driver.send(*call)
+        return time.perf_counter() - started, status
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(timed_call, calls))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        'requests': requests,
+        'errors': sum(1 for _, status in results if status >= 500),
+        'rps': round(requests / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2)
+    }
+
+def compare(results, baseline, tolerance):
+    """Prints the change against the baseline; returns the regressed scenarios."""
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+        change = (result["p95_ms"] - previous["p95_ms"]) / previous["p95_ms"] if previous["p95_ms"] else 0.0
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:<10} p95 {:>9.2f}ms vs {:>9.2f}ms ({:+.1%}){}".format(name, result["p95_ms"], previous["p95_ms"], change, flag))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000, help="Synthetic questions to seed (1k to 1M).")
+    parser.add_argument("--requests", type=int, default=1000, help="Requests per scenario.")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma separated subset of: " + ", ".join(SCENARIOS))
+    parser.add_argument("--database", help="Disposable database URL; defaults to a temporary SQLite file.")
+    parser.add_argument("--url", help="Benchmark a running server instead; skips seeding.")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for data and requests.")
+    parser.add_argument("--baseline", help="Compare against this saved result file.")
+    parser.add_argument("--save-baseline", help="Write the results to this file.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed p95 regression against the baseline.")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error("unknown scenarios: " + ", ".join(unknown))
+
+    if args.url:
+        driver = HttpDriver(args.url)
+    else:
+        database = args.database or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "trivia-bench.db")
+        # models reads DATABASE_URL at import time
+        os.environ["DATABASE_URL"] = database
+        from flaskr import create_app
+        # One client sending every request would only measure the rate limits
+        app = create_app({"RATE_LIMIT": False})
+        seed(app, args.rows, random.Random(args.seed))
+        driver = TestClientDriver(app)
+
+    results = {}
+    for name in scenarios:
+        results[name] = run_scenario(driver, SCENARIOS[name], args.requests, args.concurrency, args.rows, args.seed)
+        print("{:<10} {requests:>6} req  {rps:>9.1f} req/s  p50 {p50_ms:>8.2f}ms  p95 {p95_ms:>8.2f}ms  p99 {p99_ms:>8.2f}ms  errors {errors}".format(name, **results[name]))
+
+    report = {
+        'rows': args.rows,
+        'concurrency': args.concurrency,
+        'database': "http" if args.url else args.database or "sqlite",
+        'results': results
+    }
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as target:
+            json.dump(report, target, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as source:
+            regressions = compare(results, json.load(source), args.tolerance)
+        if regressions:
+            sys.exit("p95 regressed for: " + ", ".join(regressions))
+
+if __name__ == "__main__":
+    main()
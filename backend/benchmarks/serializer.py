@@ -0,0 +1,72 @@
+"""
+Per-row cost of building a question listing through the two read paths:
+
+    orm        Question.query.all() -> Question.format() -> jsonify()
+    projected  with_entities() tuples -> dicts -> serializers.dumps()
+
+Run from the backend directory:
+
+    python -m benchmarks.serializer --rows 10000 --repeat 5
+"""
+import argparse
+import time
+
+from flask import Flask, jsonify
+
+from models import db, setup_db, Question
+from flaskr.serializers import dumps, orjson, project_questions, question_dicts
+
+def seed(rows):
+    db.session.execute(Question.__table__.insert(), [
+        {
+            'question': "Synthetic question number {}?".format(i),
+            'answer': "Answer {}".format(i),
+            'category': i % 6 + 1,
+            'difficulty': i % 5 + 1
+        }
+        for i in range(rows)
+    ])
+    db.session.commit()
+
+def orm_path():
+    questions = Question.query.order_by(Question.id).all()
+    return jsonify({'questions': [question.format() for question in questions]}).get_data()
+
+def projected_path():
+    rows = project_questions(Question.query.order_by(Question.id)).all()
+    return dumps({'questions': question_dicts(rows)})
+
+def measure(path, repeat):
+    best = None
+    for _ in range(repeat):
+        # Start every run with an empty identity map, like a fresh request
+        db.session.remove()
+        started = time.perf_counter()
+        path()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--database", default="sqlite://", help="SQLAlchemy URL; defaults to in-memory SQLite")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    setup_db(app, args.database)
+    with app.app_context():
+        # setup_db() leaves the schema to the migrations
+        db.create_all()
+        seed(args.rows)
+        orm = measure(orm_path, args.repeat)
+        projected = measure(projected_path, args.repeat)
+
+    print("rows: {}  json backend: {}".format(args.rows, "orjson" if orjson is not None else "json"))
+    print("orm        {:8.2f} us/row".format(orm / args.rows * 1e6))
+    print("projected  {:8.2f} us/row".format(projected / args.rows * 1e6))
+    print("speedup    {:8.2f}x".format(orm / projected))
+
+if __name__ == "__main__":
+    main()
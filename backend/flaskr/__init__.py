@@ -1,30 +1,52 @@
 import os
-from flask import Flask, request, abort, jsonify
+import io
+from flask import Flask, Response, g, request, abort, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
 
-from models import setup_db, Question, Category
-
-QUESTIONS_PER_PAGE = 10 # Number to display per page
-
-def paginate_questions(request, selection):
-    page = request.args.get("page", 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-
-    questions = [question.format() for question in selection]
-    current_questions = questions[start:end]
-
-    return current_questions
+from models import database_path, replica_paths, setup_db, Question
+from .bulk import MAX_BATCH_SIZE, READERS, clean_row, export_questions, import_questions, wants_compact
+from .cache_bus import CacheBus
+from .categories import CategoryCache, category_cache
+from .cli import questions_cli
+from .counts import QuestionCounts, category_key, question_counts
+from .instrumentation import Instrumentation, instrumentation
+from .limits import AdmissionControl, admission_control, retry_after
+from .pagination import check_page, paginate_questions
+from .quiz import ALL_CATEGORIES, QuizIndex, difficulty_range, quiz_index
+from .replicas import ReplicaRouting, read_only
+from .response_cache import ResponseCache, page_key, response_cache
+from .search import QuestionSearch, question_search
+from .serializers import json_response
+from .sessions import QuizSessionStore, quiz_sessions
+from .suggest import SuggestIndex, suggest_index
+from .streaming import stream_json, stream_rows, wants_stream
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    if test_config is not None:
+        # e.g. {"SQLALCHEMY_DATABASE_URI": "sqlite://"} to run against an in-memory database
+        app.config.from_mapping(test_config)
     
     #Set up CORS. Allow '*' for origins.
-    setup_db(app)
+    setup_db(app, app.config.get("SQLALCHEMY_DATABASE_URI", database_path), app.config.get("REPLICA_DATABASE_URLS", replica_paths))
+    Instrumentation(app)
+    AdmissionControl(app)
+    ReplicaRouting(app)
+    CacheBus(app)
+    QuestionCounts(app)
+    CategoryCache(app)
+    QuestionSearch(app)
+    SuggestIndex(app)
+    QuizIndex(app)
+    QuizSessionStore(app)
+    ResponseCache(app)
     cors = CORS(app, resources={r"/*": {"origins": "*"}})
+    app.cli.add_command(questions_cli)
+
+    # A malformed cursor or an out of range page is a 400 on every listing
+    app.before_request(lambda: check_page(request))
 
     #The after_request decorator to set Access-Control-Allow
     @app.after_request
@@ -39,27 +61,27 @@ def create_app(test_config=None):
     
     #This endpoint to handles GET requests for all available categories.
     @app.route("/categories")
+    @read_only
     def get_categories():
         page = request.args.get("page", 1, type=int)
         start = (page - 1) * 10
         end = start + 10
         
-        categories = Category.query.all()
-        # print(categories)
-        formatted_categories = [category.format() for category in categories]
+        categories = category_cache().get()
         
-        if len(formatted_categories) == 0:
+        if len(categories.formatted) == 0:
             abort(404)
         
         try:
-            categories = Category.query.all()
-            categories_list = {category.id: category.type for category in categories}
-            
-            return jsonify({
+            response = json_response({
                 'success': True,
-                'categories': categories_list,
-                'total_category': len(Category.query.all())
+                'categories': categories.mapping,
+                'total_category': len(categories.formatted)
             })
+            # Clients revalidate with If-None-Match and get a 304 until a category changes
+            response.cache_control.no_cache = True
+            response.set_etag(categories.etag)
+            return response.make_conditional(request)
                 
         except Exception as e:
             print(e)
@@ -70,17 +92,28 @@ def create_app(test_config=None):
     At this point, starting the application loads questions and categories generated, ten questions per page and pagination at the bottom of the screen for three pages. Clicking on the page numbers updates the questions.
     """
     @app.route("/questions")
+    @read_only
     def get_questions():
         try:
-            selection = Question.query.order_by(Question.id).all()
-            current_questions = paginate_questions(request, selection)
-            categories = Category.query.all()
-            categories_list = {category.id: category.type for category in categories}
+            categories_list = category_cache().mapping()
+            if wants_stream(request):
+                return stream_json({
+                    'success': True,
+                    'total_questions': question_counts().total(),
+                    'categories': categories_list,
+                    'current_category': None
+                }, 'questions', stream_rows(Question.query.order_by(Question.id)))
             
-            return jsonify({
+            # Pages are cached until a question write; totals and categories come from their own caches
+            page = response_cache().page(
+                ("questions", page_key(request)),
+                ("questions",),
+                lambda: paginate_questions(request, Question.query),
+            )
+            
+            return response_cache().respond(request, page, {
                 'success': True,
-                'questions': current_questions,
-                'total_questions': len(Question.query.all()),
+                'total_questions': question_counts().total(),
                 'categories': categories_list,
                 'current_category': None
             })
@@ -101,15 +134,18 @@ def create_app(test_config=None):
                 abort(404)
                 
             question.delete()
-            selection = Question.query.order_by(Question.id).all()
-            current_questions = paginate_questions(request, selection)
+            if wants_compact(request):
+                return jsonify({"success": True, "deleted": question_id, "total_questions": question_counts().total()})
+            
+            current_questions, next_cursor = paginate_questions(request, Question.query)
             
             return jsonify(
                 {
                     "success": True,
                     "deleted": question_id,
                     "questions": current_questions,
-                    "total_questions": len(Question.query.all())
+                    "next_cursor": next_cursor,
+                    "total_questions": question_counts().total()
                 }
             )
             
@@ -125,39 +161,38 @@ def create_app(test_config=None):
     def create_question():
         body = request.get_json()
         
-        new_question = body.get("question", None)
-        new_answer = body.get("answer", None)
-        new_category = body.get("category", None)
-        new_difficulty = body.get("difficulty", None)
         search = body.get("search", None)
         
         try:
             if search:
-                selection = Question.query.order_by(Question.id).filter(Question.question.ilike("%{}%".format(search)))
-                current_questions = paginate_questions(request, selection)
+                current_questions, next_cursor, total = question_search().paginate(request, search)
                 
                 return jsonify(
                     {
                         "success": True,
                         "questions": current_questions,
-                        "total_questions": len(selection.all()),
+                        "next_cursor": next_cursor,
+                        "total_questions": total,
                     }
                 )
             
             else:
-                questions = Question(question=new_question, answer=new_answer, category=new_category, difficulty=new_difficulty)
+                # Validated here: SQLite would store a difficulty of "one" as is
+                questions = Question(**clean_row(body))
                 
                 questions.insert()
+                if wants_compact(request):
+                    return jsonify({"success": True, "created": questions.id, "total_questions": question_counts().total()})
                 
-                selection = Question.query.order_by(Question.id).all()
-                current_questions = paginate_questions(request, selection)
+                current_questions, next_cursor = paginate_questions(request, Question.query)
                 
                 return jsonify(
                     {
                         "success": True,
                         "created": questions.id,
                         "questions": current_questions,
-                        "total_questions": len(Question.query.all()),
+                        "next_cursor": next_cursor,
+                        "total_questions": question_counts().total(),
                     }
                 )
         
@@ -165,23 +200,139 @@ def create_app(test_config=None):
             abort(422)
 
     """
-    This Creates a POST endpoint to get questions based on a search term. It returns any questions for whom the search term is a substring of the question.
+    These endpoints create or delete a batch of up to 1000 questions in one transaction: either every question is written or none is.
+    They answer with the ids written and the new total instead of a page of questions. The single question endpoints above do the same with ?compact=true.
+    """
+    @app.route("/questions/batch", methods=["POST"])
+    def create_questions_batch():
+        body = request.get_json()
+        
+        try:
+            rows = body["questions"]
+            if not rows or len(rows) > MAX_BATCH_SIZE:
+                abort(422)
+            
+            questions = [Question(**clean_row(row)) for row in rows]
+            Question.insert_many(questions)
+            
+            return jsonify(
+                {
+                    "success": True,
+                    "created": [question.id for question in questions],
+                    "total_questions": question_counts().total(),
+                }
+            )
+        
+        except Exception as e:
+            print(e)
+            abort(422)
+
+    @app.route("/questions/batch", methods=["DELETE"])
+    def delete_questions_batch():
+        body = request.get_json()
+        
+        try:
+            ids = set(int(question_id) for question_id in body["ids"])
+            if not ids or len(ids) > MAX_BATCH_SIZE:
+                abort(422)
+            
+            questions = Question.query.filter(Question.id.in_(ids)).all()
+            # All or nothing: an unknown id rejects the whole batch
+            if len(questions) != len(ids):
+                abort(422)
+            
+            Question.delete_many(questions)
+            
+            return jsonify(
+                {
+                    "success": True,
+                    "deleted": sorted(ids),
+                    "total_questions": question_counts().total(),
+                }
+            )
+        
+        except Exception as e:
+            print(e)
+            abort(422)
+
+    """
+    These endpoints import and export questions in bulk, as NDJSON (one JSON question per line, the default) or CSV with a question,answer,category,difficulty header.
+    The import streams the request body into the database in chunks, one transaction per chunk, and reports how many rows it imported and how fast. The export streams every question without loading the table into memory.
+    """
+    @app.route("/questions/import", methods=["POST"])
+    def bulk_import_questions():
+        format = request.args.get("format", "csv" if request.mimetype == "text/csv" else "ndjson")
+        if format not in READERS:
+            abort(400)
+        
+        try:
+            lines = io.TextIOWrapper(request.stream, encoding="utf-8", newline="")
+            stats = import_questions(READERS[format](lines)).format()
+            
+            return jsonify(
+                {
+                    "success": True,
+                    "imported": stats["rows"],
+                    "seconds": stats["seconds"],
+                    "rows_per_second": stats["rows_per_second"],
+                    "total_questions": question_counts().total(),
+                }
+            )
+        
+        except Exception as e:
+            print(e)
+            abort(422)
+
+    @app.route("/questions/export")
+    @read_only
+    def bulk_export_questions():
+        format = request.args.get("format", "ndjson")
+        if format not in READERS:
+            abort(400)
+        
+        def progress(stats):
+            app.logger.info("exported %(rows)s questions (%(rows_per_second)s rows/s)", stats.format())
+        
+        lines = export_questions(format, progress=progress)
+        response = Response(
+            stream_with_context(lines),
+            mimetype="text/csv" if format == "csv" else "application/x-ndjson",
+        )
+        response.headers["Content-Disposition"] = "attachment; filename=questions.{}".format(format)
+        return response
+
+    """
+    This Creates a POST endpoint to get questions based on a search term. It returns the questions whose question or answer text contains every word of the search term (as a word prefix), best matches first, ten per page.
     You can search by any phrase. The questions list updates and includes only question that include that string within their question. You can try using the word "title" to start.
     """
     @app.route("/questions/search", methods=["POST"])
+    @read_only
     def search_questions():
         body = request.get_json()
         search_term = body.get("searchTerm", None)
         
         if search_term:
-            search_results = Question.query.filter(Question.question.ilike(f"%{search_term}%")).all()
-            categories = Category.query.all()
-            categories_list = [category.format() for category in categories]
-            return jsonify(
+            categories_list = category_cache().formatted()
+            if wants_stream(request):
+                total, questions = question_search().iterate(search_term)
+                return stream_json(
+                    {
+                        "success": True,
+                        "total_questions": total,
+                        "categories": categories_list,
+                        "current_category": None
+                    },
+                    "questions",
+                    questions,
+                )
+            
+            current_questions, next_cursor, total = question_search().paginate(request, search_term)
+            return json_response(
                 {
                     "success": True,
-                    "questions": [question.format() for question in search_results],
-                    "total_questions": len(search_results),
+                    "questions": current_questions,
+                    "next_cursor": next_cursor,
+                    "total_questions": total,
                     "categories": categories_list,
                     "current_category": None
                 }
@@ -189,31 +340,66 @@ def create_app(test_config=None):
         
         abort(404)
 
+    """
+    This creates a GET endpoint for search-as-you-type. It returns up to `limit` (default 10) questions whose text has a word starting with every word of `q`, from an in-memory index, without the answers and without querying the database.
+    """
+    @app.route("/questions/suggest")
+    @read_only
+    def suggest_questions():
+        term = request.args.get("q", "", type=str)
+        limit = request.args.get("limit", None, type=int)
+        
+        return json_response(
+            {
+                "success": True,
+                "suggestions": suggest_index().suggest(term, limit)
+            }
+        )
+
     """
     This creates a GET endpoint to get questions based on category.
     In the "List" tab / main screen, clicking on one of the categories in the left column causes only questions of that category to be shown.
     """
     @app.route("/categories/<int:category_id>/questions")
+    @read_only
     def get_question_category(category_id):
-        categories_new = Category.query.filter(Category.id == category_id).one_or_none()
-        if categories_new is None:
+        categories = category_cache().get()
+        if category_id not in categories.mapping:
             abort(404)
         
         try:
-            category = Category.query.get(category_id)
-            categories = Category.query.all()
-            selection = Question.query.filter(Question.category == category.id).all()
+            selection = Question.query.filter(Question.category == category_id)
             #selection = Category.query.filter_by(Category.id == category_id).one_or_none()
-            current_questions = paginate_questions(request, selection)
+            if wants_stream(request):
+                return stream_json(
+                    {
+                        "success": True,
+                        "total_questions": question_counts().total(),
+                        "total_category_questions": question_counts().for_category(category_id),
+                        "current_categories": categories.formatted,
+                        "categories": categories.formatted,
+                        "current_category": categories.mapping[category_id]
+                    },
+                    "questions",
+                    stream_rows(selection.order_by(Question.id)),
+                )
             
-            return jsonify(
+            page = response_cache().page(
+                ("category", category_id, page_key(request)),
+                (("category", category_id),),
+                lambda: paginate_questions(request, selection),
+            )
+            
+            return response_cache().respond(
+                request,
+                page,
                 {
                     "success": True,
-                    "questions": [question.format() for question in selection],
-                    "total_questions": len(Question.query.all()),
-                    "current_categories": [category.format() for category in categories],
-                    "categories": [category.format() for category in categories],
-                    "current_category": category.type
+                    "total_questions": question_counts().total(),
+                    "total_category_questions": question_counts().for_category(category_id),
+                    "current_categories": categories.formatted,
+                    "categories": categories.formatted,
+                    "current_category": categories.mapping[category_id]
                 }
             )
         
@@ -223,41 +409,35 @@ def create_app(test_config=None):
 
     """
     This creates a POST endpoint to get questions to play the quiz. This endpoint takes category and previous question parameters and returns a random questions within the given category, if provided, and that is not one of the previous questions.
+    An optional quiz_difficulty (a difficulty, a list of them or {"min": .., "max": ..}) limits the draw to those difficulties. Questions are drawn weighted by difficulty (QUIZ_DIFFICULTY_WEIGHTS) and, with QUIZ_FAVOR_UNSERVED, towards questions served less often.
     In the "Play" tab, after a user selects "All" or a category, one question at a time is displayed, the user is allowed to answer and shown whether they were correct or not.
     """
     @app.route("/quizzes", methods=["POST"])
+    @read_only
     def get_quiz():
         try:
             body = request.get_json()
             
             prev_questions = body.get("previous_questions", None)
+            if len(prev_questions) > app.config["QUIZ_MAX_PREVIOUS_QUESTIONS"]:
+                abort(422)
             #quiz_answer = body.get("quiz_answer")
             quiz_category = body.get("quiz_category", None)
-            #quiz_difficulty = body.get("quiz_difficulty")
+            difficulties = difficulty_range(body.get("quiz_difficulty", None))
                 
-            if quiz_category["id"] == 0:
-                #questions = Question.query.filter(Question.id.notin_(prev_questions)).all()
-                questions = Question.query.all()
-            
-            else:
-                questions = Question.query.filter(Question.category == quiz_category["id"], Question.id.notin_(prev_questions)).all()
-                #questions = Question.query.filter(Question.category == quiz_category["id"]).all()
-            
-            quiz_questions = []
+            category_id = category_key(quiz_category["id"])
+            if category_id != ALL_CATEGORIES and category_id not in category_cache().mapping():
+                abort(422)
             
-            for question in questions:
-                if question.id not in prev_questions:
-                    quiz_questions.append(question)
+            random_question = quiz_index().next_question(category_id, set(prev_questions), difficulties=difficulties)
                     
-            if len(quiz_questions) == 0:
+            if random_question is None:
                 return jsonify({
                 'success': True,
                 'question': None
                 #'question': random_question.format()
             })
                 
-            random_question = random.choice(quiz_questions)
-            
             return jsonify({
                 'success': True,
                 'question': random_question.format()
@@ -266,6 +446,71 @@ def create_app(test_config=None):
             print(e)
             abort(422)
 
+    """
+    These endpoints play a quiz through a server-side session instead of resending previous_questions.
+    POST /quizzes/sessions starts a session for a quiz_category (and optional quiz_difficulty) and returns its token, POST /quizzes/sessions/<token>/next returns a random question of the category that the session has not served yet (null when none are left) and DELETE /quizzes/sessions/<token> ends the session.
+    """
+    @app.route("/quizzes/sessions", methods=["POST"])
+    @read_only
+    def start_quiz_session():
+        try:
+            body = request.get_json()
+            quiz_category = body.get("quiz_category", None)
+            difficulties = difficulty_range(body.get("quiz_difficulty", None))
+            
+            category_id = category_key(quiz_category["id"])
+            if category_id != ALL_CATEGORIES and category_id not in category_cache().mapping():
+                abort(422)
+            
+            session = quiz_sessions().start(category_id, difficulties)
+            
+            return jsonify({
+                'success': True,
+                'session': session.token,
+                'quiz_category': quiz_category,
+                'expires_in': app.config["QUIZ_SESSION_TTL"]
+            })
+        except Exception as e:
+            print(e)
+            abort(422)
+
+    @app.route("/quizzes/sessions/<token>/next", methods=["POST"])
+    @read_only
+    def next_quiz_question(token):
+        session = quiz_sessions().get(token)
+        if session is None:
+            abort(404)
+        
+        with session.lock:
+            random_question = quiz_index().next_question(session.category_id, session.seen, difficulties=session.difficulties)
+            if random_question is not None:
+                session.seen.add(random_question.id)
+        
+        return jsonify({
+            'success': True,
+            'question': random_question.format() if random_question is not None else None,
+            'answered': len(session.seen)
+        })
+
+    @app.route("/quizzes/sessions/<token>", methods=["DELETE"])
+    def end_quiz_session(token):
+        session = quiz_sessions().end(token)
+        if session is None:
+            abort(404)
+        
+        return jsonify({
+            'success': True,
+            'ended': token,
+            'answered': len(session.seen)
+        })
+
+    """
+    This endpoint exposes per-endpoint request latency, database time, query and row counts, and requests turned away by the rate and concurrency limits, in the Prometheus text format.
+    """
+    @app.route("/metrics")
+    def get_metrics():
+        return Response(instrumentation().render() + admission_control().render(), mimetype="text/plain; version=0.0.4")
+
     """
     Here are the error handlers for all expected errors
     including 404 and 422.
@@ -291,6 +536,14 @@ def create_app(test_config=None):
             405,
         )
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return (
+            jsonify({"success": False, "error": 429, "message": "too many requests"}),
+            429,
+            {"Retry-After": retry_after(g.get("retry_after", 1))},
+        )
+
     @app.errorhandler(400)
     def bad_request(error):
         return (
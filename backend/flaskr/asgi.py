@@ -0,0 +1,409 @@
+import os
+import random
+
+from flask import abort
+from sqlalchemy import select
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_etags, quote_etag
+
+from models import DB_PGBOUNCER, Question
+from . import create_app
+from .categories import category_cache
+from .counts import category_key, question_counts
+from .limits import admission_control, client_address, limited_endpoint, retry_after
+from .pagination import QUESTIONS_PER_PAGE, check_page, decode_cursor, page_number, page_result
+from .quiz import ALL_CATEGORIES, difficulty_range, quiz_index
+from .replicas import reads_primary
+from .response_cache import page_key
+from .serializers import QUESTION_COLUMNS, QUESTION_KEYS, dumps
+from .sessions import quiz_sessions
+from .streaming import wants_stream
+from .suggest import suggest_index
+
+try:
+    import databases
+    from starlette.applications import Starlette
+    from starlette.background import BackgroundTask
+    from starlette.concurrency import run_in_threadpool
+    from starlette.middleware.wsgi import WSGIMiddleware
+    from starlette.responses import Response, StreamingResponse
+    from starlette.routing import Mount, Route
+except ImportError: # optional: pip install -r requirements-async.txt
+    databases = None
+
+# Same headers as the after_request hook and flask_cors add in create_app
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": "Content-Type, Authorization, true",
+    "Access-Control-Allow-Methods": "GET, PUT, PATCH, POST, DELETE, OPTIONS",
+}
+
+# Status -> body of the error handlers in create_app
+ERRORS = {
+    400: {"success": False, "error": 400, "message": "bad request"},
+    404: {"success": False, "error": 404, "message": "resource not found"},
+    405: {"success": False, "error": 405, "message": "Method Not Allowed"},
+    422: {"success": False, "error": 422, "message": "unprocessable"},
+    429: {"success": False, "error": 429, "message": "too many requests"},
+    500: {"success": False, "error": 400, "message": "server error"},
+}
+
+"""
+QueryArgs
+    the query string of an ASGI request as a werkzeug MultiDict under
+    `args`, so helpers written against flask.request (page_key,
+    wants_stream, the cursor parsing) work unchanged
+"""
+class QueryArgs:
+
+    def __init__(self, request):
+        self.args = MultiDict(request.query_params.multi_items())
+
+def record_dict(record):
+    return {key: record[key] for key in QUESTION_KEYS}
+
+def json_response(payload, status=200, headers=None):
+    return Response(dumps(payload), status_code=status, media_type="application/json", headers=dict(CORS_HEADERS, **(headers or {})))
+
+"""
+create_asgi_app(test_config)
+    async serving mode: an ASGI application with the same routes, response
+    bodies and error handlers as create_app().
+    The read and quiz endpoints run as coroutines and read rows through an
+    async driver (asyncpg for Postgres, aiosqlite for SQLite) via the
+    `databases` package, so a waiting query never holds a worker thread.
+    With read replicas configured those reads go to a replica, except for
+    clients that have just written (see flaskr.replicas).
+    Every other route (writes, search, import/export, /metrics) is served by
+    the Flask app itself, mounted underneath and run in a thread pool.
+    Both halves share one process and the same in-memory caches, so writes
+    made through Flask invalidate what the async routes serve.
+    Anything that may block on the caches (a reload after a reset, counts
+    with QUESTION_COUNTS_CACHE off, the cache bus check) runs in the thread
+    pool as well, never on the event loop.
+
+    Serve it with: uvicorn --factory flaskr.asgi:create_asgi_app
+"""
+def create_asgi_app(test_config=None):
+    if databases is None:
+        raise RuntimeError("the async serving mode needs the packages in requirements-async.txt")
+
+    app = create_app(test_config)
+    # ASYNC_DATABASE_URL overrides the URL the Flask app was set up with
+    url = os.getenv("ASYNC_DATABASE_URL") or app.config["SQLALCHEMY_DATABASE_URI"]
+    options = {}
+    if DB_PGBOUNCER and url.startswith("postgres"):
+        # Prepared statements do not survive PgBouncer's transaction pooling
+        options["statement_cache_size"] = 0
+    database = databases.Database(url, **options)
+    replicas = [databases.Database(path, **options) for key, path in sorted(app.config["SQLALCHEMY_BINDS"].items()) if key.startswith("replica_")]
+
+    def reader(request):
+        # Every async route only reads; clients that just wrote stay on the primary
+        if replicas and not reads_primary(request.cookies):
+            return random.choice(replicas)
+        return database
+
+    def in_context(call):
+        # The extensions read current_app. Nothing in `call` awaits, so the
+        # context never spans a task switch. Only for calls that never wait
+        # on I/O: anything else goes through in_thread().
+        with app.app_context():
+            return call()
+
+    async def in_thread(call):
+        # Calls that may query the database or the cache bus backend (a cache
+        # rebuilding after a reset, counts with QUESTION_COUNTS_CACHE off)
+        # run in the thread pool, so they never stall the event loop
+        return await run_in_threadpool(in_context, call)
+
+    def warm_caches():
+        with app.app_context():
+            try:
+                question_counts().total()
+                category_cache().get()
+                quiz_index().pool_size()
+                len(suggest_index())
+            except Exception as e:
+                # The caches load on first use instead
+                app.logger.warning("could not warm caches: %s", e)
+
+    async def startup():
+        for connection in [database] + replicas:
+            await connection.connect()
+        await run_in_threadpool(warm_caches)
+
+    async def shutdown():
+        for connection in [database] + replicas:
+            await connection.disconnect()
+
+    def page_select(query, *criteria):
+        selection = select(list(QUESTION_COLUMNS)).order_by(Question.id)
+        for criterion in criteria:
+            selection = selection.where(criterion)
+
+        cursor = query.args.get("cursor", None, type=str)
+        if cursor:
+            selection = selection.where(Question.id > decode_cursor(cursor))
+        else:
+            page = page_number(query)
+            selection = selection.offset(max(page - 1, 0) * QUESTIONS_PER_PAGE)
+        return selection.limit(QUESTIONS_PER_PAGE + 1)
+
+    async def cached_page(source, key, tags, selection):
+        cache = app.extensions["response_cache"]
+        entry, generations = in_context(lambda: cache.lookup(key, tags))
+        if entry is None:
+            questions, next_cursor = page_result([record_dict(record) for record in await source.fetch_all(selection)])
+            entry = in_context(lambda: cache.store(key, tags, generations, questions, next_cursor, replica=source is not database))
+        return entry
+
+    def page_response(request, page, envelope):
+        etag, body = app.extensions["response_cache"].render(page, envelope, parse_etags(request.headers.get("if-none-match")))
+        headers = {"ETag": quote_etag(etag), "Cache-Control": "no-cache"}
+        if body is None:
+            return Response(status_code=304, headers=dict(CORS_HEADERS, **headers))
+        return Response(body, media_type="application/json", headers=dict(CORS_HEADERS, **headers))
+
+    def stream_response(source, envelope, key, selection):
+        async def generate():
+            yield dumps(envelope)[:-1] + (b"," if envelope else b"") + dumps(key) + b":["
+            first = True
+            async for record in source.iterate(selection):
+                yield (b"" if first else b",") + dumps(record_dict(record))
+                first = False
+            yield b"]}"
+
+        return StreamingResponse(generate(), media_type="application/json", headers=CORS_HEADERS)
+
+    def admitted(handler):
+        # The Flask app's before_request work: admission control, under the
+        # same endpoint names, the cache bus check and the page check
+        async def admit(request):
+            query = QueryArgs(request)
+            endpoint = limited_endpoint(handler.__name__, query)
+            check_page(query)
+            bus = app.extensions["cache_bus"]
+            if bus.due():
+                await in_thread(bus.sync)
+            client = request.client.host if request.client else None
+            holds_slot, wait = in_context(lambda: admission_control().admit(endpoint, client_address(client, request.headers)))
+            if wait is not None:
+                return json_response(ERRORS[429], status=429, headers={"Retry-After": retry_after(wait)})
+            if not holds_slot:
+                return await handler(request)
+            release = app.extensions["admission_control"].release
+            try:
+                response = await handler(request)
+            except BaseException:
+                release(endpoint)
+                raise
+            # Held until the body has been sent, streamed ones included
+            response.background = BackgroundTask(release, endpoint)
+            return response
+
+        return admit
+
+    async def next_question(source, draw):
+        """
+        Question dict for the id `draw(index)` takes from the quiz index, or
+        None. Ids whose row has disappeared are dropped and drawn again.
+        """
+        index = app.extensions["quiz_index"]
+        while True:
+            question_id = await in_thread(lambda: draw(index))
+            if question_id is None:
+                return None
+            selection = select(list(QUESTION_COLUMNS)).where(Question.id == question_id)
+            record = await source.fetch_one(selection)
+            if record is None and source is not database:
+                # A question inserted moments ago may not have replicated yet
+                record = await database.fetch_one(selection)
+            # The index lock may be held by a thread loading it
+            if record is not None:
+                await in_thread(lambda: index.serve(question_id))
+                return record_dict(record)
+            await in_thread(lambda: index.discard(question_id))
+
+    async def get_categories(request):
+        categories = await in_thread(lambda: category_cache().get())
+
+        if len(categories.formatted) == 0:
+            abort(404)
+
+        headers = {"ETag": quote_etag(categories.etag), "Cache-Control": "no-cache"}
+        if categories.etag in parse_etags(request.headers.get("if-none-match")):
+            return Response(status_code=304, headers=dict(CORS_HEADERS, **headers))
+
+        return json_response({
+            'success': True,
+            'categories': categories.mapping,
+            'total_category': len(categories.formatted)
+        }, headers=headers)
+
+    async def get_questions(request):
+        query = QueryArgs(request)
+        try:
+            envelope = await in_thread(lambda: {
+                'success': True,
+                'total_questions': question_counts().total(),
+                'categories': category_cache().mapping(),
+                'current_category': None
+            })
+            if wants_stream(query):
+                return stream_response(reader(request), envelope, 'questions', select(list(QUESTION_COLUMNS)).order_by(Question.id))
+
+            page = await cached_page(reader(request), ("questions", page_key(query)), ("questions",), page_select(query))
+            return page_response(request, page, envelope)
+        except Exception as e:
+            print(e)
+            abort(404)
+
+    async def suggest_questions(request):
+        query = QueryArgs(request)
+        suggestions = await in_thread(lambda: suggest_index().suggest(query.args.get("q", "", type=str), query.args.get("limit", None, type=int)))
+
+        return json_response({
+            "success": True,
+            "suggestions": suggestions
+        })
+
+    async def get_question_category(request):
+        category_id = request.path_params["category_id"]
+        categories = await in_thread(lambda: category_cache().get())
+        if category_id not in categories.mapping:
+            abort(404)
+
+        query = QueryArgs(request)
+        try:
+            envelope = await in_thread(lambda: {
+                "success": True,
+                "total_questions": question_counts().total(),
+                "total_category_questions": question_counts().for_category(category_id),
+                "current_categories": categories.formatted,
+                "categories": categories.formatted,
+                "current_category": categories.mapping[category_id]
+            })
+            if wants_stream(query):
+                selection = select(list(QUESTION_COLUMNS)).where(Question.category == category_id).order_by(Question.id)
+                return stream_response(reader(request), envelope, "questions", selection)
+
+            page = await cached_page(
+                reader(request),
+                ("category", category_id, page_key(query)),
+                (("category", category_id),),
+                page_select(query, Question.category == category_id),
+            )
+            return page_response(request, page, envelope)
+        except Exception as e:
+            print(e)
+            abort(400)
+
+    async def get_quiz(request):
+        try:
+            body = await request.json()
+
+            prev_questions = body.get("previous_questions", None)
+            if len(prev_questions) > app.config["QUIZ_MAX_PREVIOUS_QUESTIONS"]:
+                abort(422)
+            quiz_category = body.get("quiz_category", None)
+            difficulties = difficulty_range(body.get("quiz_difficulty", None))
+
+            category_id = category_key(quiz_category["id"])
+            if category_id != ALL_CATEGORIES and category_id not in await in_thread(lambda: category_cache().mapping()):
+                abort(422)
+
+            seen = set(prev_questions)
+            question = await next_question(reader(request), lambda index: index.sample(category_id, seen, difficulties=difficulties))
+
+            return json_response({
+                'success': True,
+                'question': question
+            })
+        except Exception as e:
+            print(e)
+            abort(422)
+
+    async def start_quiz_session(request):
+        try:
+            body = await request.json()
+            quiz_category = body.get("quiz_category", None)
+            difficulties = difficulty_range(body.get("quiz_difficulty", None))
+
+            category_id = category_key(quiz_category["id"])
+            if category_id != ALL_CATEGORIES and category_id not in await in_thread(lambda: category_cache().mapping()):
+                abort(422)
+
+            session = in_context(lambda: quiz_sessions().start(category_id, difficulties))
+
+            return json_response({
+                'success': True,
+                'session': session.token,
+                'quiz_category': quiz_category,
+                'expires_in': app.config["QUIZ_SESSION_TTL"]
+            })
+        except Exception as e:
+            print(e)
+            abort(422)
+
+    async def next_quiz_question(request):
+        token = request.path_params["token"]
+        session = in_context(lambda: quiz_sessions().get(token))
+        if session is None:
+            abort(404)
+
+        def draw(index):
+            # The id is marked seen as it is drawn: the session lock cannot be
+            # held across the row fetch, and concurrent calls must not draw it
+            # again meanwhile
+            with session.lock:
+                question_id = index.sample(session.category_id, session.seen, difficulties=session.difficulties)
+                if question_id is not None:
+                    session.seen.add(question_id)
+                return question_id
+
+        question = await next_question(reader(request), draw)
+
+        return json_response({
+            'success': True,
+            'question': question,
+            'answered': len(session.seen)
+        })
+
+    async def end_quiz_session(request):
+        token = request.path_params["token"]
+        session = in_context(lambda: quiz_sessions().end(token))
+        if session is None:
+            abort(404)
+
+        return json_response({
+            'success': True,
+            'ended': token,
+            'answered': len(session.seen)
+        })
+
+    async def http_error(request, error):
+        body = ERRORS.get(error.code) or {"success": False, "error": error.code, "message": error.name}
+        return json_response(body, status=error.code)
+
+    async def server_error(request, error):
+        return json_response(ERRORS[500], status=500)
+
+    return Starlette(
+        routes=[
+            Route("/categories", admitted(get_categories), methods=["GET"]),
+            Route("/questions", admitted(get_questions), methods=["GET"]),
+            Route("/questions/suggest", admitted(suggest_questions), methods=["GET"]),
+            Route("/categories/{category_id:int}/questions", admitted(get_question_category), methods=["GET"]),
+            Route("/quizzes", admitted(get_quiz), methods=["POST"]),
+            Route("/quizzes/sessions", admitted(start_quiz_session), methods=["POST"]),
+            Route("/quizzes/sessions/{token}/next", admitted(next_quiz_question), methods=["POST"]),
+            Route("/quizzes/sessions/{token}", admitted(end_quiz_session), methods=["DELETE"]),
+            # Everything else is the Flask app, run in a thread pool
+            Mount("/", app=WSGIMiddleware(app)),
+        ],
+        exception_handlers={HTTPException: http_error, Exception: server_error},
+        on_startup=[startup],
+        on_shutdown=[shutdown],
+    )
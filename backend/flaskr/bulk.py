@@ -0,0 +1,198 @@
+import csv
+import io
+import json
+import time
+
+from flask import current_app
+
+from models import db, notify_write, Question
+
+IMPORT_CHUNK_SIZE = 1000 # Rows per transaction when importing
+EXPORT_BATCH_SIZE = 1000 # Rows fetched per round-trip when exporting
+MAX_BATCH_SIZE = 1000 # Questions per batch create or delete request
+COLUMNS = ("question", "answer", "category", "difficulty")
+
+"""
+TransferStats
+    rows moved so far by an import or export and how fast
+"""
+class TransferStats:
+
+    def __init__(self):
+        self.rows = 0
+        self.chunks = 0
+        self.started = time.perf_counter()
+
+    @property
+    def seconds(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def rows_per_second(self):
+        seconds = self.seconds
+        return self.rows / seconds if seconds > 0 else 0.0
+
+    def format(self):
+        return {
+            'rows': self.rows,
+            'chunks': self.chunks,
+            'seconds': round(self.seconds, 3),
+            'rows_per_second': round(self.rows_per_second, 1)
+            }
+
+"""
+read_ndjson(lines) / read_csv(lines)
+    turn an iterable of text lines (a file, a request stream) into question
+    dicts one row at a time, without reading the whole input
+"""
+def read_ndjson(lines):
+    for number, line in enumerate(lines, 1):
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                raise ValueError("line {}: invalid JSON".format(number))
+
+def read_csv(lines):
+    return csv.DictReader(lines)
+
+READERS = {"ndjson": read_ndjson, "csv": read_csv}
+
+"""
+wants_compact(request)
+    True when a mutation should answer with ids and totals only
+    (?compact=true) instead of re-reading a page of questions
+"""
+def wants_compact(request):
+    return request.args.get("compact", "false").lower() in ("1", "true", "yes")
+
+"""
+clean_row(row)
+    validated insert values for one imported question; raises ValueError
+"""
+def clean_row(row):
+    try:
+        values = {
+            'question': row["question"],
+            'answer': row["answer"],
+            'category': int(row["category"]),
+            'difficulty': int(row["difficulty"])
+            }
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("invalid question row: {!r}".format(row))
+    if not values["question"] or not values["answer"]:
+        raise ValueError("invalid question row: {!r}".format(row))
+    return values
+
+"""
+import_questions(rows, chunk_size, progress)
+    inserts question dicts in chunks of `chunk_size`, one transaction per
+    chunk: a multi-row INSERT, or COPY ... FROM STDIN on Postgres when
+    BULK_IMPORT_COPY is enabled. `progress(stats)` runs after every chunk.
+    Returns the TransferStats. Chunks committed before an invalid row stay
+    imported.
+"""
+def import_questions(rows, chunk_size=IMPORT_CHUNK_SIZE, progress=None):
+    use_copy = db.engine.dialect.name == "postgresql" and current_app.config.get("BULK_IMPORT_COPY", True)
+    write_chunk = _copy_chunk if use_copy else _insert_chunk
+    stats = TransferStats()
+
+    try:
+        chunk = []
+        for row in rows:
+            chunk.append(clean_row(row))
+            if len(chunk) >= chunk_size:
+                _flush(write_chunk, chunk, stats, progress)
+                chunk = []
+        if chunk:
+            _flush(write_chunk, chunk, stats, progress)
+    finally:
+        if stats.rows:
+            # Rows did not go through Question.insert(), so derived data is rebuilt
+            notify_write(Question.__tablename__, "reset", None)
+
+    return stats
+
+def _flush(write_chunk, chunk, stats, progress):
+    write_chunk(chunk)
+    stats.rows += len(chunk)
+    stats.chunks += 1
+    if progress is not None:
+        progress(stats)
+
+def _insert_chunk(chunk):
+    try:
+        db.session.execute(Question.__table__.insert(), chunk)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+def _copy_chunk(chunk):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for values in chunk:
+        writer.writerow([values[column] for column in COLUMNS])
+    buffer.seek(0)
+
+    connection = db.engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                "COPY questions ({}) FROM STDIN WITH (FORMAT csv)".format(", ".join(COLUMNS)),
+                buffer,
+            )
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+"""
+export_questions(format, batch_size, progress)
+    generator of NDJSON lines or CSV rows (header first) for every question,
+    ordered by id. Rows are fetched `batch_size` at a time through a
+    server-side cursor where the driver supports one, so memory stays flat.
+    `progress(stats)` runs after every batch and once at the end.
+"""
+def export_questions(format="ndjson", batch_size=EXPORT_BATCH_SIZE, progress=None):
+    if format not in READERS:
+        raise ValueError("unknown export format: {}".format(format))
+
+    columns = ("id",) + COLUMNS
+    rows = (
+        db.session.query(*[getattr(Question, column) for column in columns])
+        .order_by(Question.id)
+        .execution_options(stream_results=True)
+        .yield_per(batch_size)
+    )
+    stats = TransferStats()
+
+    if format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        def encode(values):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(values)
+            return buffer.getvalue()
+
+        yield encode(columns)
+    else:
+        def encode(values):
+            return json.dumps(dict(zip(columns, values))) + "\n"
+
+    for row in rows:
+        yield encode(row)
+        stats.rows += 1
+        if stats.rows % batch_size == 0:
+            stats.chunks += 1
+            if progress is not None:
+                progress(stats)
+
+    if stats.rows % batch_size:
+        stats.chunks += 1
+    if progress is not None:
+        progress(stats)
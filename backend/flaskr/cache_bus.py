@@ -0,0 +1,236 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+from flask import current_app, g
+
+from models import notify_write, on_write, Category, Question
+
+try:
+    import redis
+except ImportError: # optional: pip install redis
+    redis = None
+
+CHANNEL = "trivia:writes"
+VERSION_KEY = "trivia:version:{}" # Writes so far to a table, across all workers
+TABLES = (Question.__tablename__, Category.__tablename__)
+
+"""
+MemoryBroker
+    in-process stand-in for a Redis server: shared counters and
+    publish/subscribe. Apps created with the same memory:// CACHE_URL share
+    one broker, like workers sharing a Redis, which is what the tests use.
+    Each message is delivered on a thread of its own, as from Redis (so the
+    subscriber's app context and session stay apart from the publisher's),
+    but publish() waits for it.
+"""
+class MemoryBroker:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._subscribers = {}
+
+    def get(self, key):
+        with self._lock:
+            return self._values.get(key)
+
+    def incr(self, key):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + 1
+            return self._values[key]
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for callback in subscribers:
+            delivery = threading.Thread(target=callback, args=(message,))
+            delivery.start()
+            delivery.join()
+
+    def subscribe(self, channel, callback):
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(callback)
+
+brokers = {}
+
+"""
+RedisBackend
+    the same interface over a Redis (or Redis-compatible) server; messages
+    are delivered on a background thread
+"""
+class RedisBackend:
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError("a redis:// CACHE_URL needs the redis package")
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._client.get(key)
+        return int(value) if value is not None else None
+
+    def incr(self, key):
+        return self._client.incr(key)
+
+    def publish(self, channel, message):
+        self._client.publish(channel, message)
+
+    def subscribe(self, channel, callback):
+        pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{channel: lambda message: callback(message["data"].decode("utf-8"))})
+        pubsub.run_in_thread(sleep_time=0.01, daemon=True)
+
+"""
+cache_backend(url)
+    backend for a CACHE_URL: memory://<name> for an in-process broker shared
+    by every app using that name, or redis://...
+"""
+def cache_backend(url):
+    if url.startswith("memory://"):
+        return brokers.setdefault(url, MemoryBroker())
+    return RedisBackend(url)
+
+"""
+CacheBus
+    keeps the in-process caches of several workers (question counts, the
+    category snapshot, the quiz and suggest indexes, cached listing pages)
+    consistent through a shared backend set by CACHE_URL. Hits are still
+    served from each worker's memory.
+    Every committed write bumps the table's version in the backend and is
+    published with that version; the other workers replay it through their
+    own write listeners, so they update incrementally within milliseconds.
+    A worker that sees a version out of order, or finds the shared version
+    ahead of its own when it checks (at most every CACHE_SYNC_INTERVAL
+    seconds, per request), may have missed a message and replays a "reset"
+    instead, rebuilding that table's derived data.
+    Without CACHE_URL every worker keeps to itself, as before.
+"""
+class CacheBus:
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._app = None
+        self._backend = None
+        self._pid = None
+        self._origin = None
+        self._versions = {}
+        self._own = {}
+        self._checked_at = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("CACHE_URL", os.getenv("CACHE_URL"))
+        app.config.setdefault("CACHE_SYNC_INTERVAL", 1.0)
+        app.extensions["cache_bus"] = self
+        app.before_request(self.sync)
+        self._app = app
+
+    @property
+    def enabled(self):
+        return bool(self._app.config["CACHE_URL"])
+
+    def connect(self):
+        """Subscribes this process to the channel once (again after a fork)."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._backend = cache_backend(self._app.config["CACHE_URL"])
+            self._origin = uuid.uuid4().hex
+            for table in TABLES:
+                self._versions[table] = self._backend.get(VERSION_KEY.format(table)) or 0
+                self._own[table] = set()
+            self._backend.subscribe(CHANNEL, self._receive)
+            self._pid = os.getpid()
+
+    def publish(self, table, event, row, previous=None):
+        if not self.enabled:
+            return
+        self.connect()
+        version = self._backend.incr(VERSION_KEY.format(table))
+        with self._lock:
+            # The local listeners have applied it already
+            self._own[table].add(version)
+            self._catch_up(table)
+        self._backend.publish(CHANNEL, json.dumps({
+            "origin": self._origin,
+            "table": table,
+            "version": version,
+            "event": event,
+            "row": row,
+            "previous": previous,
+        }))
+
+    def due(self):
+        """Whether sync() would check the backend now; never waits on it."""
+        return self.enabled and time.monotonic() - self._checked_at >= self._app.config["CACHE_SYNC_INTERVAL"]
+
+    def sync(self):
+        """Replays a reset for every table whose shared version is ahead of this worker."""
+        if not self.due():
+            return
+        self.connect()
+        self._checked_at = time.monotonic()
+
+        for table in TABLES:
+            shared = self._backend.get(VERSION_KEY.format(table)) or 0
+            with self._lock:
+                stale = shared > self._versions[table]
+                if stale:
+                    self._skip_to(table, shared)
+            if stale:
+                self._replay(table, "reset", None, None)
+
+    def _receive(self, message):
+        message = json.loads(message)
+        if message["origin"] == self._origin:
+            return
+        table, version = message["table"], message["version"]
+        with self._lock:
+            if version <= self._versions[table]:
+                # Already covered by a reset
+                return
+            in_order = version == self._versions[table] + 1
+            if in_order:
+                self._versions[table] = version
+                self._catch_up(table)
+            else:
+                self._skip_to(table, version)
+
+        if in_order:
+            self._replay(table, message["event"], message["row"], message["previous"])
+        else:
+            self._replay(table, "reset", None, None)
+
+    def _catch_up(self, table):
+        # Own writes that follow the last applied version need no replay
+        own = self._own[table]
+        while self._versions[table] + 1 in own:
+            self._versions[table] += 1
+            own.discard(self._versions[table])
+
+    def _skip_to(self, table, version):
+        self._versions[table] = version
+        self._own[table] = set(v for v in self._own[table] if v > version)
+        self._catch_up(table)
+
+    def _replay(self, table, event, row, previous):
+        with self._app.app_context():
+            g.replaying_write = True
+            notify_write(table, event, row, previous)
+
+def cache_bus():
+    return current_app.extensions["cache_bus"]
+
+def _publisher(table):
+    def publish(event, row, previous):
+        bus = current_app.extensions.get("cache_bus")
+        if bus is not None and not g.get("replaying_write"):
+            bus.publish(table, event, row, previous)
+    return publish
+
+for table in TABLES:
+    on_write(table, _publisher(table))
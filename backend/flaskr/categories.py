@@ -0,0 +1,74 @@
+import hashlib
+import json
+import threading
+from collections import namedtuple
+
+from flask import current_app
+
+from models import on_write, Category
+from .replicas import primary
+
+"""
+CategorySnapshot
+    one consistent view of the categories table: the {id: type} map, the
+    list of format() dicts and an ETag derived from their content
+"""
+CategorySnapshot = namedtuple("CategorySnapshot", ["version", "mapping", "formatted", "etag"])
+
+"""
+CategoryCache
+    in-process cache of the categories table keyed by a version number.
+    Any Category insert/update/delete bumps the version, and the next read
+    reloads the table once; every other read is served without the database.
+"""
+class CategoryCache:
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._version = 0
+        self._snapshot = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions["category_cache"] = self
+
+    @property
+    def version(self):
+        return self._version
+
+    def bump(self):
+        with self._lock:
+            self._version += 1
+            self._snapshot = None
+
+    def get(self):
+        with self._lock:
+            if self._snapshot is None or self._snapshot.version != self._version:
+                self._snapshot = self._load(self._version)
+            return self._snapshot
+
+    def mapping(self):
+        return self.get().mapping
+
+    def formatted(self):
+        return self.get().formatted
+
+    def _load(self, version):
+        # From the primary, or a lagging replica could pin an old version
+        with primary():
+            categories = Category.query.order_by(Category.id).all()
+        formatted = [category.format() for category in categories]
+        mapping = {category["id"]: category["type"] for category in formatted}
+        digest = hashlib.sha1(json.dumps(formatted, sort_keys=True).encode("utf-8"))
+        return CategorySnapshot(version, mapping, formatted, digest.hexdigest())
+
+def category_cache():
+    return current_app.extensions["category_cache"]
+
+def _on_category_write(event, row, previous):
+    cache = current_app.extensions.get("category_cache")
+    if cache is not None:
+        cache.bump()
+
+on_write(Category.__tablename__, _on_category_write)
@@ -0,0 +1,54 @@
+import sys
+
+import click
+from flask.cli import AppGroup
+
+from .bulk import IMPORT_CHUNK_SIZE, READERS, export_questions, import_questions
+
+questions_cli = AppGroup("questions", help="Bulk import and export of questions.")
+
+def _format_for(path, format):
+    if format:
+        return format
+    return "csv" if path and path.lower().endswith(".csv") else "ndjson"
+
+def _report(verb):
+    def progress(stats):
+        click.echo(
+            "{} {rows} questions ({rows_per_second} rows/s)".format(verb, **stats.format()),
+            err=True,
+        )
+    return progress
+
+"""
+flask questions import FILE
+    streams an NDJSON or CSV file (chosen by extension or --format) into the
+    questions table, one transaction per chunk
+"""
+@questions_cli.command("import")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "format", type=click.Choice(sorted(READERS)), help="Defaults to the file extension.")
+@click.option("--chunk-size", default=IMPORT_CHUNK_SIZE, show_default=True, help="Rows per transaction.")
+def import_command(path, format, chunk_size):
+    with open(path, newline="", encoding="utf-8") as source:
+        rows = READERS[_format_for(path, format)](source)
+        try:
+            stats = import_questions(rows, chunk_size, progress=_report("imported"))
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    click.echo("imported {rows} questions in {seconds}s ({rows_per_second} rows/s)".format(**stats.format()))
+
+"""
+flask questions export [FILE]
+    streams every question as NDJSON or CSV to FILE, or to stdout
+"""
+@questions_cli.command("export")
+@click.argument("path", required=False, type=click.Path(dir_okay=False, writable=True))
+@click.option("--format", "format", type=click.Choice(sorted(READERS)), help="Defaults to the file extension.")
+def export_command(path, format):
+    lines = export_questions(_format_for(path, format), progress=_report("exported"))
+    if path is None:
+        sys.stdout.writelines(lines)
+        return
+    with open(path, "w", newline="", encoding="utf-8") as target:
+        target.writelines(lines)
@@ -0,0 +1,111 @@
+import threading
+
+from flask import current_app
+from sqlalchemy import func
+
+from models import db, on_write, writes_pending, Question
+from .replicas import primary
+
+"""
+category_key(value)
+    normalises a category id to the integer questions.category holds (a
+    foreign key to categories.id). Clients may send it as a string, as
+    quiz_category {"id": "4"} does, so "4" and 4 look up the same total
+"""
+def category_key(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+"""
+QuestionCounts
+    global and per-category question totals.
+    With QUESTION_COUNTS_CACHE enabled (the default) the totals are loaded
+    with a single GROUP BY on first use and then kept up to date by
+    Question.insert(), update() and delete(), so reading them costs O(1).
+    Otherwise every read is a SQL COUNT.
+    Every write event bumps a generation. A load is kept only if no event
+    came and no write was pending while it ran, so a write is never both
+    in the loaded totals and applied on top of them.
+"""
+class QuestionCounts:
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._by_category = None
+        self._generation = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("QUESTION_COUNTS_CACHE", True)
+        app.extensions["question_counts"] = self
+
+    def total(self):
+        if not current_app.config["QUESTION_COUNTS_CACHE"]:
+            return db.session.query(func.count(Question.id)).scalar()
+        return sum(self._counts().values())
+
+    def for_category(self, category_id):
+        if not current_app.config["QUESTION_COUNTS_CACHE"]:
+            return Question.query.filter(Question.category == category_id).count()
+        return self._counts().get(category_key(category_id), 0)
+
+    def reset(self):
+        with self._lock:
+            self._generation += 1
+            self._by_category = None
+
+    def apply(self, event, row, previous=None):
+        with self._lock:
+            self._generation += 1
+            if self._by_category is None:
+                return
+            if event == "reset":
+                self._by_category = None
+            elif event == "insert":
+                self._add(row["category"], 1)
+            elif event == "delete":
+                self._add(row["category"], -1)
+            elif event == "update":
+                self._add(previous["category"], -1)
+                self._add(row["category"], 1)
+
+    def _add(self, category, delta):
+        key = category_key(category)
+        self._by_category[key] = self._by_category.get(key, 0) + delta
+
+    def _counts(self):
+        with self._lock:
+            if self._by_category is not None:
+                return self._by_category
+            generation = self._generation
+
+        with primary():
+            rows = (
+                db.session.query(Question.category, func.count(Question.id))
+                .group_by(Question.category)
+                .all()
+            )
+        by_category = {}
+        for category, count in rows:
+            key = category_key(category)
+            by_category[key] = by_category.get(key, 0) + count
+
+        with self._lock:
+            if self._by_category is not None:
+                return self._by_category
+            if generation == self._generation and not writes_pending(Question.__tablename__):
+                self._by_category = by_category
+            return by_category
+
+def question_counts():
+    return current_app.extensions["question_counts"]
+
+def _on_question_write(event, row, previous):
+    counts = current_app.extensions.get("question_counts")
+    if counts is not None:
+        counts.apply(event, row, previous)
+
+on_write(Question.__tablename__, _on_question_write)
@@ -0,0 +1,257 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+from models import db, on_pool_checkout
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+"""
+RequestStats
+    what one request spent: queries and rows seen by the engine, and time
+    waiting for a pooled connection, in the database, in JSON serialization
+    and in total
+"""
+class RequestStats:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.rows = 0
+        self.phases = {"pool": 0.0, "db": 0.0, "serialize": 0.0}
+
+    @property
+    def total(self):
+        return time.perf_counter() - self.started
+
+def current_stats():
+    return g.get("request_stats") if has_app_context() else None
+
+"""
+timed(phase)
+    adds the time spent in the block to `phase` of the current request
+"""
+@contextmanager
+def timed(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats = current_stats()
+        if stats is not None:
+            stats.phases[phase] = stats.phases.get(phase, 0.0) + time.perf_counter() - started
+
+"""
+Histogram
+    Prometheus-style cumulative histogram
+"""
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def render(self, name, labels):
+        lines = []
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, count))
+        lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, labels, self.count))
+        lines.append('{}_sum{{{}}} {}'.format(name, labels, self.sum))
+        lines.append('{}_count{{{}}} {}'.format(name, labels, self.count))
+        return lines
+
+"""
+EndpointMetrics
+    aggregated timings and database work of every request to one endpoint
+"""
+class EndpointMetrics:
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.db = Histogram()
+        self.serialize_seconds = 0.0
+        self.queries = 0
+        self.rows = 0
+
+"""
+Instrumentation
+    per-request telemetry hooked into the request pipeline and SQLAlchemy
+    engine events. Every response gets a Server-Timing header (pool, db,
+    serialize, app and total phases, with query and row counts) and
+    per-endpoint totals are rendered in the Prometheus text format for
+    /metrics, along with connection pool waits and saturation. Row counts are
+    what the driver reports: psycopg2 counts SELECT rows, SQLite only DML.
+    The header is set before a streamed body is generated, so it leaves the
+    streaming out; the totals are recorded at teardown, once the body is
+    done, and include it.
+    Set INSTRUMENTATION to False to turn it off.
+"""
+class Instrumentation:
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._pool_wait = Histogram()
+        self._pool_timeouts = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("INSTRUMENTATION", True)
+        app.extensions["instrumentation"] = self
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._record_request)
+        app.json_encoder = _timed_encoder(app.json_encoder)
+
+    def _start_request(self):
+        if current_app.config["INSTRUMENTATION"]:
+            g.request_stats = RequestStats()
+
+    def _finish_request(self, response):
+        stats = current_stats()
+        if stats is None:
+            return response
+
+        total = stats.total
+        pool_seconds = stats.phases["pool"]
+        db_seconds = stats.phases["db"]
+        serialize_seconds = stats.phases["serialize"]
+        response.headers["Server-Timing"] = ", ".join([
+            "pool;dur={:.2f}".format(pool_seconds * 1000),
+            'db;dur={:.2f};desc="{} queries, {} rows"'.format(db_seconds * 1000, stats.queries, stats.rows),
+            "serialize;dur={:.2f}".format(serialize_seconds * 1000),
+            "app;dur={:.2f}".format(max(total - pool_seconds - db_seconds - serialize_seconds, 0.0) * 1000),
+            "total;dur={:.2f}".format(total * 1000),
+        ])
+        return response
+
+    def _record_request(self, exc):
+        stats = current_stats()
+        if stats is None:
+            return
+        with self._lock:
+            metrics = self._endpoints.setdefault(request.endpoint or "unknown", EndpointMetrics())
+            metrics.latency.observe(stats.total)
+            metrics.db.observe(stats.phases["db"])
+            metrics.serialize_seconds += stats.phases["serialize"]
+            metrics.queries += stats.queries
+            metrics.rows += stats.rows
+
+    def observe_checkout(self, seconds, timed_out):
+        with self._lock:
+            self._pool_wait.observe(seconds)
+            if timed_out:
+                self._pool_timeouts += 1
+
+    def render(self):
+        """Prometheus text exposition of the per-endpoint metrics."""
+        lines = [
+            "# HELP trivia_request_duration_seconds Request latency by endpoint.",
+            "# TYPE trivia_request_duration_seconds histogram",
+        ]
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            for endpoint, metrics in endpoints:
+                lines.extend(metrics.latency.render("trivia_request_duration_seconds", 'endpoint="{}"'.format(endpoint)))
+
+            lines.append("# HELP trivia_db_duration_seconds Database time per request by endpoint.")
+            lines.append("# TYPE trivia_db_duration_seconds histogram")
+            for endpoint, metrics in endpoints:
+                lines.extend(metrics.db.render("trivia_db_duration_seconds", 'endpoint="{}"'.format(endpoint)))
+
+            for name, kind, help, attribute in (
+                ("trivia_serialize_seconds_total", "counter", "Time spent encoding JSON by endpoint.", "serialize_seconds"),
+                ("trivia_db_queries_total", "counter", "SQL statements executed by endpoint.", "queries"),
+                ("trivia_db_rows_total", "counter", "Rows reported by the driver by endpoint.", "rows"),
+            ):
+                lines.append("# HELP {} {}".format(name, help))
+                lines.append("# TYPE {} {}".format(name, kind))
+                for endpoint, metrics in endpoints:
+                    lines.append('{}{{endpoint="{}"}} {}'.format(name, endpoint, getattr(metrics, attribute)))
+
+            lines.append("# HELP trivia_db_pool_wait_seconds Time to check a connection out of the pool.")
+            lines.append("# TYPE trivia_db_pool_wait_seconds histogram")
+            lines.extend(self._pool_wait.render("trivia_db_pool_wait_seconds", 'pool="default"'))
+            lines.append("# HELP trivia_db_pool_timeouts_total Checkouts that gave up after pool_timeout.")
+            lines.append("# TYPE trivia_db_pool_timeouts_total counter")
+            lines.append('trivia_db_pool_timeouts_total{{pool="default"}} {}'.format(self._pool_timeouts))
+
+        lines.extend(_pool_gauges(db.engine.pool))
+        return "\n".join(lines) + "\n"
+
+def instrumentation():
+    return current_app.extensions["instrumentation"]
+
+def _pool_gauges(pool):
+    """Current size and use of a QueuePool; saturation is checked out / (size + max_overflow)."""
+    if not isinstance(pool, QueuePool):
+        return []
+    checked_out = pool.checkedout()
+    gauges = [
+        ("trivia_db_pool_size", "Connections the pool keeps open.", pool.size()),
+        ("trivia_db_pool_checked_out", "Connections in use.", checked_out),
+        ("trivia_db_pool_overflow", "Connections open beyond the pool size.", max(pool.overflow(), 0)),
+    ]
+    # A negative max_overflow means the pool never runs out
+    if pool._max_overflow >= 0:
+        gauges.append(("trivia_db_pool_saturation", "Share of the pool's capacity in use.", checked_out / float(pool.size() + pool._max_overflow or 1)))
+
+    lines = []
+    for name, help, value in gauges:
+        lines.append("# HELP {} {}".format(name, help))
+        lines.append("# TYPE {} gauge".format(name))
+        lines.append('{}{{pool="default"}} {}'.format(name, value))
+    return lines
+
+def _timed_encoder(base):
+    class TimedJSONEncoder(base):
+        def encode(self, o):
+            with timed("serialize"):
+                return super().encode(o)
+    return TimedJSONEncoder
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    stats = current_stats()
+    if stats is not None:
+        stats.queries += 1
+        stats.phases["db"] += time.perf_counter() - started
+        if cursor.rowcount is not None and cursor.rowcount > 0:
+            stats.rows += cursor.rowcount
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    started = context.connection.info.get("query_started") if context.connection is not None else None
+    if started:
+        started.pop()
+
+@on_pool_checkout
+def _on_pool_checkout(seconds, timed_out):
+    stats = current_stats()
+    if stats is not None:
+        stats.phases["pool"] += seconds
+    if has_app_context():
+        instruments = current_app.extensions.get("instrumentation")
+        if instruments is not None:
+            instruments.observe_checkout(seconds, timed_out)
@@ -0,0 +1,203 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import abort, current_app, g, request
+
+from .streaming import wants_stream
+
+# endpoint -> (requests per second, burst) for each client; see limited_endpoint()
+RATE_LIMITS = {
+    "search_questions": (5, 20),
+    "create_question:search": (5, 20),
+    "get_questions:stream": (0.2, 2),
+    "get_question_category:stream": (0.5, 5),
+    "start_quiz_session": (1, 10),
+    "get_quiz": (10, 30),
+    "next_quiz_question": (10, 30),
+    "create_questions_batch": (1, 5),
+    "delete_questions_batch": (1, 5),
+    "bulk_import_questions": (0.2, 2),
+    "bulk_export_questions": (0.2, 2),
+}
+# endpoint -> requests served at once by this process, across clients
+CONCURRENCY_LIMITS = {
+    "search_questions": 8,
+    "create_question:search": 8,
+    "get_questions:stream": 2,
+    "get_question_category:stream": 4,
+    "get_quiz": 16,
+    "next_quiz_question": 16,
+    "bulk_import_questions": 1,
+    "bulk_export_questions": 2,
+}
+CONCURRENCY_RETRY_AFTER = 1 # Seconds a request turned away for concurrency is told to wait
+
+"""
+TokenBucket
+    `burst` tokens refilled at `rate` per second; every request takes one
+"""
+class TokenBucket:
+
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = now
+
+    def take(self, now):
+        """0 when a token was taken, otherwise the seconds until one is available."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+"""
+limited_endpoint(endpoint, request)
+    the name an endpoint's limits are kept under. Full listings streamed
+    with ?stream=true are "<endpoint>:stream" and the search branch of
+    POST /questions is "create_question:search", so the expensive requests
+    get limits of their own instead of sharing the cheap ones'.
+"""
+def limited_endpoint(endpoint, request):
+    if wants_stream(request):
+        return endpoint + ":stream"
+    if endpoint == "create_question":
+        # Served by Flask only, so `request` is flask.request here
+        body = request.get_json(silent=True)
+        if isinstance(body, dict) and body.get("search"):
+            return endpoint + ":search"
+    return endpoint
+
+"""
+client_address(remote_addr, headers)
+    the address requests are limited by: the first X-Forwarded-For entry
+    when RATE_LIMIT_TRUST_PROXY is set (behind a proxy that sets it),
+    otherwise the peer address
+"""
+def client_address(remote_addr, headers):
+    if current_app.config["RATE_LIMIT_TRUST_PROXY"]:
+        forwarded = headers.get("X-Forwarded-For", "")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return remote_addr
+
+"""
+AdmissionControl
+    load shedding in front of the views. Each client gets a token bucket per
+    endpoint (RATE_LIMITS, where an (endpoint, client) key overrides the
+    endpoint's limit for one client), and each endpoint serves at most
+    CONCURRENCY_LIMITS requests at once. A request over either limit is
+    answered 429 with Retry-After before it reaches the database.
+    Limits are per process: with N workers a client gets N times the rate.
+    RATE_LIMIT turns it off; RATE_LIMIT_EXEMPT lists clients never limited.
+"""
+class AdmissionControl:
+
+    def __init__(self, app=None, clock=time.monotonic):
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+        self._in_flight = {}
+        self._rejected = {}
+        self._clock = clock
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("RATE_LIMIT", True)
+        app.config.setdefault("RATE_LIMITS", RATE_LIMITS)
+        app.config.setdefault("CONCURRENCY_LIMITS", CONCURRENCY_LIMITS)
+        app.config.setdefault("RATE_LIMIT_EXEMPT", ())
+        app.config.setdefault("RATE_LIMIT_TRUST_PROXY", False)
+        app.config.setdefault("RATE_LIMIT_CLIENTS", 100000)
+        app.extensions["admission_control"] = self
+        app.before_request(self._admit_request)
+        app.teardown_request(self._release_request)
+
+    def admit(self, endpoint, client):
+        """
+        (holds_slot, retry_after). retry_after is None when the request may
+        go ahead, otherwise the seconds to wait before retrying. holds_slot
+        tells whether it took a concurrency slot, to give back with
+        release(endpoint) once it is done.
+        """
+        config = current_app.config
+        if not config["RATE_LIMIT"] or client in config["RATE_LIMIT_EXEMPT"]:
+            return False, None
+        limits = config["RATE_LIMITS"]
+        rate = limits.get((endpoint, client), limits.get(endpoint))
+        concurrency = config["CONCURRENCY_LIMITS"].get(endpoint)
+
+        with self._lock:
+            if rate is not None:
+                now = self._clock()
+                key = (endpoint, client)
+                # Least recently seen clients are forgotten beyond RATE_LIMIT_CLIENTS
+                bucket = self._buckets.pop(key, None) or TokenBucket(*rate, now=now)
+                self._buckets[key] = bucket
+                while len(self._buckets) > config["RATE_LIMIT_CLIENTS"]:
+                    self._buckets.popitem(last=False)
+                wait = bucket.take(now)
+                if wait:
+                    self._reject(endpoint, "rate")
+                    return False, wait
+
+            if concurrency is None:
+                return False, None
+            if self._in_flight.get(endpoint, 0) >= concurrency:
+                self._reject(endpoint, "concurrency")
+                return False, CONCURRENCY_RETRY_AFTER
+            self._in_flight[endpoint] = self._in_flight.get(endpoint, 0) + 1
+            return True, None
+
+    def release(self, endpoint):
+        with self._lock:
+            self._in_flight[endpoint] -= 1
+
+    def render(self):
+        """Prometheus text exposition of rejections and requests in flight."""
+        lines = [
+            "# HELP trivia_requests_rejected_total Requests answered 429 by endpoint and limit.",
+            "# TYPE trivia_requests_rejected_total counter",
+        ]
+        with self._lock:
+            for (endpoint, limit), count in sorted(self._rejected.items()):
+                lines.append('trivia_requests_rejected_total{{endpoint="{}",limit="{}"}} {}'.format(endpoint, limit, count))
+            lines.append("# HELP trivia_requests_in_flight Requests holding a concurrency slot by endpoint.")
+            lines.append("# TYPE trivia_requests_in_flight gauge")
+            for endpoint, count in sorted(self._in_flight.items()):
+                lines.append('trivia_requests_in_flight{{endpoint="{}"}} {}'.format(endpoint, count))
+        return "\n".join(lines) + "\n"
+
+    def _reject(self, endpoint, limit):
+        self._rejected[(endpoint, limit)] = self._rejected.get((endpoint, limit), 0) + 1
+
+    def _admit_request(self):
+        if request.endpoint is None:
+            return
+        endpoint = limited_endpoint(request.endpoint, request)
+        holds_slot, wait = self.admit(endpoint, client_address(request.remote_addr, request.headers))
+        if holds_slot:
+            g.admission_slot = endpoint
+        if wait is not None:
+            g.retry_after = wait
+            abort(429)
+
+    def _release_request(self, error=None):
+        # Runs once a streamed response has been sent, too
+        endpoint = g.pop("admission_slot", None)
+        if endpoint is not None:
+            self.release(endpoint)
+
+"""
+retry_after(seconds)
+    Retry-After header value: whole seconds, at least 1
+"""
+def retry_after(seconds):
+    return str(max(int(math.ceil(seconds)), 1))
+
+def admission_control():
+    return current_app.extensions["admission_control"]
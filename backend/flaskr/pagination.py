@@ -0,0 +1,100 @@
+import base64
+import binascii
+
+from flask import abort
+
+from models import Question
+from .serializers import project_questions, question_dicts
+
+QUESTIONS_PER_PAGE = 10 # Number to display per page
+MAX_POSITION = 2 ** 63 - 1 # Largest id or offset the database takes (a BIGINT)
+
+"""
+encode_cursor(question_id) / decode_cursor(cursor)
+    opaque keyset cursors: a cursor points just past the last question id
+    of the page it was returned with. A cursor that does not decode to an
+    id or offset in 0..MAX_POSITION aborts with 400.
+"""
+def encode_cursor(question_id):
+    raw = base64.urlsafe_b64encode(str(question_id).encode("ascii"))
+    return raw.decode("ascii").rstrip("=")
+
+def decode_cursor(cursor):
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        position = int(base64.urlsafe_b64decode(padded.encode("ascii")).decode("ascii"))
+    except (binascii.Error, UnicodeError, ValueError):
+        abort(400)
+    if not 0 <= position <= MAX_POSITION:
+        abort(400)
+    return position
+
+"""
+page_number(request)
+    the requested ?page= (1 when missing or not a number). Aborts with 400
+    when its offset would not fit in the database's integers.
+"""
+def page_number(request, per_page=QUESTIONS_PER_PAGE):
+    page = request.args.get("page", 1, type=int)
+    if (page - 1) * per_page > MAX_POSITION:
+        abort(400)
+    return page
+
+"""
+check_page(request)
+    aborts with 400 when the request carries a malformed ?cursor= or an
+    out of range ?page=. Run before the views (a before_request hook, and
+    the async routes' wrapper), whose own error handling would otherwise
+    answer 404, 422 or 500 instead.
+"""
+def check_page(request):
+    cursor = request.args.get("cursor", None, type=str)
+    if cursor:
+        decode_cursor(cursor)
+    else:
+        page_number(request)
+
+"""
+paginate_questions(request, selection)
+    runs one page of `selection` (a Question query) in the database and
+    returns (questions, next_cursor). Only the question columns are
+    selected; rows are never hydrated into Question objects.
+    With ?cursor=... the page is a keyset scan on Question.id, otherwise
+    ?page=N is translated to LIMIT/OFFSET. Either way only the rows on the
+    page are loaded and formatted.
+"""
+def paginate_questions(request, selection, per_page=QUESTIONS_PER_PAGE):
+    cursor = request.args.get("cursor", None, type=str)
+    selection = selection.order_by(Question.id)
+
+    if cursor:
+        selection = selection.filter(Question.id > decode_cursor(cursor))
+    else:
+        page = page_number(request, per_page)
+        selection = selection.offset(max(page - 1, 0) * per_page)
+
+    # One extra row tells us whether there is a next page without a COUNT
+    rows = project_questions(selection).limit(per_page + 1).all()
+    return page_result(question_dicts(rows), per_page)
+
+"""
+page_result(questions, per_page)
+    splits the per_page + 1 question dicts read for a page into the page
+    and the cursor of the next one
+"""
+def page_result(questions, per_page=QUESTIONS_PER_PAGE):
+    next_cursor = encode_cursor(questions[per_page - 1]["id"]) if len(questions) > per_page else None
+    return questions[:per_page], next_cursor
+
+"""
+page_offset(request)
+    offset of the requested page for listings that cannot be keyset
+    paginated, such as relevance-ranked search. Their cursors carry the
+    offset of the next page instead of a question id.
+"""
+def page_offset(request, per_page=QUESTIONS_PER_PAGE):
+    cursor = request.args.get("cursor", None, type=str)
+    if cursor:
+        return decode_cursor(cursor)
+    page = page_number(request, per_page)
+    return max(page - 1, 0) * per_page
@@ -0,0 +1,334 @@
+import random
+import threading
+
+from flask import current_app
+
+from models import db, on_write, Question
+from .counts import category_key
+from .replicas import primary, reading_replica
+
+ALL_CATEGORIES = 0 # quiz_category id the front-end sends for "All"
+REJECTION_TRIES = 16 # Random draws before falling back to an exact pick
+DIFFICULTY_WEIGHTS = {1: 1.0, 2: 2.0, 3: 3.0, 4: 2.0, 5: 1.0} # Medium questions come up most
+
+"""
+difficulty_range(value)
+    the difficulties asked for by a quiz_difficulty value: a difficulty, a
+    list of them or {"min": low, "max": high}, all within the
+    DIFFICULTY_WEIGHTS difficulties. Returns a tuple of ints, or None (any
+    difficulty) for None; raises ValueError.
+"""
+def difficulty_range(value):
+    if value is None:
+        return None
+    lowest, highest = min(DIFFICULTY_WEIGHTS), max(DIFFICULTY_WEIGHTS)
+    if isinstance(value, dict):
+        low = int(value.get("min", lowest))
+        high = int(value.get("max", highest))
+        # Bounds are checked before the range is expanded
+        if not lowest <= low <= high <= highest:
+            raise ValueError("invalid difficulty range: {!r}".format(value))
+        return tuple(range(low, high + 1))
+    if isinstance(value, (list, tuple)):
+        difficulties = tuple(sorted(set(int(difficulty) for difficulty in value)))
+    else:
+        difficulties = (int(value),)
+    if not difficulties:
+        raise ValueError("empty difficulty range: {!r}".format(value))
+    if difficulties[0] < lowest or difficulties[-1] > highest:
+        raise ValueError("difficulty out of range: {!r}".format(value))
+    return difficulties
+
+"""
+FenwickTree
+    binary indexed tree over slot weights: changing a weight and finding the
+    slot a cumulative weight falls in both take O(log n)
+"""
+class FenwickTree:
+
+    def __init__(self, weights=(), capacity=16):
+        self.capacity = max(capacity, len(weights), 1)
+        self.tree = [0.0] * (self.capacity + 1)
+        # Linear-time build: every node passes its sum on to its parent
+        for i, weight in enumerate(weights, 1):
+            self.tree[i] += weight
+            parent = i + (i & -i)
+            if parent <= self.capacity:
+                self.tree[parent] += self.tree[i]
+
+    def add(self, slot, delta):
+        i = slot + 1
+        while i <= self.capacity:
+            self.tree[i] += delta
+            i += i & -i
+
+    def find(self, value):
+        """Slot s with weight(0..s-1) <= value < weight(0..s)."""
+        position = 0
+        step = 1 << (self.capacity.bit_length() - 1)
+        while step:
+            following = position + step
+            if following <= self.capacity and self.tree[following] <= value:
+                position = following
+                value -= self.tree[following]
+            step >>= 1
+        return position
+
+"""
+WeightedPool
+    question ids with a weight each, in an array (removal swaps in the last
+    element) indexed by a FenwickTree, so ids are added, removed, reweighted
+    and drawn with probability proportional to their weight in O(log n)
+"""
+class WeightedPool:
+
+    def __init__(self):
+        self.ids = []
+        self.weights = []
+        self.positions = {}
+        self.total = 0.0
+        self._tree = FenwickTree()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, question_id):
+        return question_id in self.positions
+
+    def add(self, question_id, weight):
+        if question_id in self.positions:
+            self.set_weight(question_id, weight)
+            return
+        slot = len(self.ids)
+        if slot >= self._tree.capacity:
+            self._tree = FenwickTree(self.weights, capacity=2 * self._tree.capacity)
+        self.positions[question_id] = slot
+        self.ids.append(question_id)
+        self.weights.append(weight)
+        self._tree.add(slot, weight)
+        self.total += weight
+
+    def remove(self, question_id):
+        position = self.positions.pop(question_id, None)
+        if position is None:
+            return
+        weight = self.weights[position]
+        last_slot = len(self.ids) - 1
+        if position == last_slot:
+            self._tree.add(position, -weight)
+        else:
+            last, last_weight = self.ids[last_slot], self.weights[last_slot]
+            self._tree.add(last_slot, -last_weight)
+            self._tree.add(position, last_weight - weight)
+            self.ids[position], self.weights[position] = last, last_weight
+            self.positions[last] = position
+        self.ids.pop()
+        self.weights.pop()
+        self.total = self.total - weight if self.ids else 0.0
+
+    def weight(self, question_id):
+        position = self.positions.get(question_id)
+        return self.weights[position] if position is not None else 0.0
+
+    def set_weight(self, question_id, weight):
+        position = self.positions.get(question_id)
+        if position is None:
+            return
+        delta = weight - self.weights[position]
+        self.weights[position] = weight
+        self._tree.add(position, delta)
+        self.total += delta
+
+    def draw_at(self, value):
+        """Id whose slot holds cumulative weight `value` (0 <= value < total)."""
+        return self.ids[min(self._tree.find(value), len(self.ids) - 1)]
+
+"""
+weighted_sample(pools, seen, rng)
+    id drawn from `pools` with probability proportional to its weight,
+    leaving out the ids in `seen` (anything supporting `in`), or None once
+    every id has been seen
+"""
+def weighted_sample(pools, seen, rng=random):
+    pools = [pool for pool in pools if len(pool)]
+    if not pools:
+        return None
+
+    # While most of the weight is unseen a few random draws find an id
+    for _ in range(REJECTION_TRIES):
+        candidate = _draw(pools, rng)
+        if candidate is None:
+            return None
+        if candidate not in seen:
+            return candidate
+
+    # Otherwise take the weight of the seen ids out, draw, and put it back:
+    # O(S log P) for S seen ids
+    removed = []
+    for pool in pools:
+        for question_id in seen:
+            if question_id in pool:
+                removed.append((pool, question_id, pool.weight(question_id)))
+                pool.set_weight(question_id, 0.0)
+    try:
+        if len(removed) == sum(len(pool) for pool in pools):
+            return None
+        candidate = _draw(pools, rng)
+        if candidate is None or candidate in seen:
+            # Only rounding can land on a zeroed slot; any unseen id will do
+            candidate = next(question_id for pool in pools for question_id in pool.ids if question_id not in seen)
+        return candidate
+    finally:
+        for pool, question_id, weight in removed:
+            pool.set_weight(question_id, weight)
+
+def _draw(pools, rng):
+    total = sum(pool.total for pool in pools)
+    if total <= 0:
+        return None
+    value = rng.random() * total
+    for pool in pools:
+        if value < pool.total:
+            return pool.draw_at(value)
+        value -= pool.total
+    return pools[-1].draw_at(pools[-1].total * rng.random())
+
+"""
+QuizIndex
+    weighted pools of question ids per category and difficulty (plus
+    per-difficulty pools of every question), built with a single query on
+    first use and kept up to date by Question.insert(), update() and
+    delete(). A quiz step draws an unseen id from the pools of the requested
+    difficulties and then loads just that row by primary key.
+    A question's weight is its difficulty's QUIZ_DIFFICULTY_WEIGHTS entry,
+    divided by one plus the times this process has served it when
+    QUIZ_FAVOR_UNSERVED is set, so rarely served questions come up first.
+"""
+class QuizIndex:
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._pools = None
+        self._questions = {}
+        self._served = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("QUIZ_DIFFICULTY_WEIGHTS", DIFFICULTY_WEIGHTS)
+        app.config.setdefault("QUIZ_FAVOR_UNSERVED", True)
+        # Longer previous_questions lists are refused; long quizzes use sessions
+        app.config.setdefault("QUIZ_MAX_PREVIOUS_QUESTIONS", 1000)
+        app.extensions["quiz_index"] = self
+
+    def reset(self):
+        with self._lock:
+            self._pools = None
+
+    def pool_size(self, category_id=ALL_CATEGORIES, difficulties=None):
+        with self._lock:
+            return sum(len(pool) for pool in self._buckets(category_id, difficulties))
+
+    def sample(self, category_id, seen, rng=random, difficulties=None):
+        with self._lock:
+            return weighted_sample(self._buckets(category_id, difficulties), seen, rng)
+
+    def next_question(self, category_id, seen, rng=random, difficulties=None):
+        """
+        Random Question of the category and difficulties that is not in
+        `seen`, or None. Ids whose row has disappeared (e.g. deleted by
+        another worker) are dropped from the index and another one is drawn.
+        """
+        while True:
+            question_id = self.sample(category_id, seen, rng, difficulties)
+            if question_id is None:
+                return None
+            question = Question.query.get(question_id)
+            if question is None and reading_replica():
+                # A question inserted moments ago may not have replicated yet
+                with primary():
+                    question = Question.query.get(question_id)
+            if question is not None:
+                self.serve(question_id)
+                return question
+            self.discard(question_id)
+
+    def serve(self, question_id):
+        """Counts a question as served, lowering its weight."""
+        with self._lock:
+            self._served[question_id] = self._served.get(question_id, 0) + 1
+            if self._pools is not None and question_id in self._questions:
+                category, difficulty = self._questions[question_id]
+                weight = self._weight(question_id, difficulty)
+                for pool in self._pools_of(category, difficulty):
+                    pool.set_weight(question_id, weight)
+
+    def discard(self, question_id):
+        with self._lock:
+            if self._pools is not None:
+                self._remove(question_id)
+
+    def apply(self, event, row, previous=None):
+        with self._lock:
+            if self._pools is None:
+                return
+            if event == "reset":
+                self._pools = None
+                return
+            if event in ("delete", "update"):
+                old = previous if previous is not None else row
+                self._remove(old["id"])
+            if event in ("insert", "update"):
+                self._add(row["id"], row["category"], row["difficulty"])
+            if event == "delete":
+                self._served.pop(row["id"], None)
+
+    def _weight(self, question_id, difficulty):
+        weight = current_app.config["QUIZ_DIFFICULTY_WEIGHTS"].get(difficulty, 1.0)
+        if current_app.config["QUIZ_FAVOR_UNSERVED"]:
+            weight /= 1 + self._served.get(question_id, 0)
+        return weight
+
+    def _pools_of(self, category, difficulty):
+        return (
+            self._pools.setdefault(category_key(category), {}).setdefault(difficulty, WeightedPool()),
+            self._pools[ALL_CATEGORIES].setdefault(difficulty, WeightedPool()),
+        )
+
+    def _add(self, question_id, category, difficulty):
+        self._questions[question_id] = (category_key(category), difficulty)
+        weight = self._weight(question_id, difficulty)
+        for pool in self._pools_of(category, difficulty):
+            pool.add(question_id, weight)
+
+    def _remove(self, question_id):
+        question = self._questions.pop(question_id, None)
+        if question is not None:
+            for pool in self._pools_of(*question):
+                pool.remove(question_id)
+
+    def _buckets(self, category_id, difficulties):
+        by_difficulty = self._load().get(category_key(category_id), {})
+        if difficulties is None:
+            return list(by_difficulty.values())
+        return [by_difficulty[difficulty] for difficulty in difficulties if difficulty in by_difficulty]
+
+    def _load(self):
+        if self._pools is None:
+            self._pools = {ALL_CATEGORIES: {}}
+            self._questions = {}
+            with primary():
+                rows = db.session.query(Question.id, Question.category, Question.difficulty).order_by(Question.id)
+                for question_id, category, difficulty in rows:
+                    self._add(question_id, category, difficulty)
+        return self._pools
+
+def quiz_index():
+    return current_app.extensions["quiz_index"]
+
+def _on_question_write(event, row, previous):
+    index = current_app.extensions.get("quiz_index")
+    if index is not None:
+        index.apply(event, row, previous)
+
+on_write(Question.__tablename__, _on_question_write)
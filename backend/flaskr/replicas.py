@@ -0,0 +1,90 @@
+import math
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request
+
+from models import db, on_write, Category, Question
+
+PRIMARY_COOKIE = "trivia_primary_until"
+
+"""
+read_only(view)
+    marks a view whose queries may be served by a read replica
+"""
+def read_only(view):
+    view.replica_reads = True
+    return view
+
+"""
+reads_primary(cookies)
+    True while a client's own recent write may not have reached the
+    replicas yet, so its reads must stay on the primary
+"""
+def reads_primary(cookies):
+    try:
+        return float(cookies.get(PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+"""
+reading_replica()
+    True when the current session's queries go to a replica
+"""
+def reading_replica():
+    return db.session().reads_replica
+
+"""
+primary()
+    sends the current session's queries in the block to the primary, e.g.
+    for the initial load of an in-memory index or cache from a read_only
+    view. Loaded from the primary: the write listeners only keep it current
+    from here on
+"""
+@contextmanager
+def primary():
+    session = db.session()
+    use_replica = session.use_replica
+    session.use_replica = False
+    try:
+        yield
+    finally:
+        session.use_replica = use_replica
+
+"""
+ReplicaRouting
+    routes the queries of views marked read_only to the read replicas
+    configured in setup_db (DB_REPLICA_HOST or REPLICA_DATABASE_URL), and
+    everything else to the primary. A response to a request that wrote gets
+    a cookie that keeps the client's reads on the primary for
+    REPLICA_MAX_LAG seconds, so it reads its own writes.
+"""
+class ReplicaRouting:
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("REPLICA_MAX_LAG", 5)
+        app.extensions["replica_routing"] = self
+        app.before_request(self._route_reads)
+        app.after_request(self._stick_to_primary)
+
+    def _route_reads(self):
+        view = current_app.view_functions.get(request.endpoint)
+        if getattr(view, "replica_reads", False) and not reads_primary(request.cookies):
+            db.session().use_replica = True
+
+    def _stick_to_primary(self, response):
+        if g.get("wrote_primary"):
+            lag = current_app.config["REPLICA_MAX_LAG"]
+            response.set_cookie(PRIMARY_COOKIE, "{:.3f}".format(time.time() + lag), max_age=math.ceil(lag))
+        return response
+
+def _on_write(event, row, previous):
+    if has_request_context():
+        g.wrote_primary = True
+
+on_write(Question.__tablename__, _on_write)
+on_write(Category.__tablename__, _on_write)
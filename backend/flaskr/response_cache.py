@@ -0,0 +1,219 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, current_app
+
+from models import on_write, Question
+from .counts import category_key
+from .instrumentation import timed
+from .replicas import reading_replica
+from .serializers import dumps
+
+"""
+CachedPage
+    one page of a listing as loaded from the database (its question dicts and
+    next cursor), plus the last response body built from it and that body's
+    ETag
+"""
+class CachedPage:
+
+    def __init__(self, questions, next_cursor):
+        self.questions = questions
+        self.next_cursor = next_cursor
+        encoded = dumps([questions, next_cursor])
+        self.digest = hashlib.sha1(encoded).hexdigest()
+        # the rows plus the body built from them
+        self.size = 2 * len(encoded)
+        self.etag = None
+        self.body = None
+
+"""
+ResponseCache
+    LRU cache of listing pages keyed on endpoint, category and page/cursor,
+    bounded by RESPONSE_CACHE_ENTRIES entries and RESPONSE_CACHE_BYTES bytes.
+
+    Every page is tagged with what it was read from: "questions" for the
+    global listing, ("category", id) for a category listing. Question
+    insert/update/delete invalidate exactly the tags the written row belongs
+    to, so other categories' pages survive. Totals and the category map are
+    not cached with the page: they are read from their own O(1) caches on
+    every request and folded into the ETag, so a cached page never carries a
+    stale total.
+    A page read from a replica within REPLICA_MAX_LAG seconds of its tag's
+    last invalidation may predate the write, so it is served but not cached.
+"""
+class ResponseCache:
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._generations = {}
+        self._epoch = 0 # Bumped by clear(), for tags with no entries too
+        self._invalidated_at = {}
+        self._cleared_at = None
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("RESPONSE_CACHE", True)
+        app.config.setdefault("RESPONSE_CACHE_ENTRIES", 1024)
+        app.config.setdefault("RESPONSE_CACHE_BYTES", 32 * 1024 * 1024)
+        app.extensions["response_cache"] = self
+
+    def __len__(self):
+        return len(self._entries)
+
+    def page(self, key, tags, load):
+        """
+        Cached page for `key`, or the (questions, next_cursor) returned by
+        load(), which is cached unless one of `tags` was invalidated while
+        it ran.
+        """
+        entry, generations = self.lookup(key, tags)
+        if entry is None:
+            entry = self.store(key, tags, generations, *load(), replica=reading_replica())
+        return entry
+
+    def lookup(self, key, tags):
+        """
+        (entry, None) on a hit, otherwise (None, generations) to hand to
+        store() once the page has been read
+        """
+        if not current_app.config["RESPONSE_CACHE"]:
+            return None, None
+
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached[0], None
+            self.misses += 1
+            return None, self._generations_of(tags)
+
+    def store(self, key, tags, generations, questions, next_cursor, replica=False):
+        entry = CachedPage(questions, next_cursor)
+        if generations is None:
+            return entry
+
+        with self._lock:
+            if replica and not self._settled(tags):
+                return entry
+            if generations == self._generations_of(tags) and key not in self._entries:
+                self._entries[key] = (entry, tags)
+                self._bytes += entry.size
+                for tag in tags:
+                    self._tags.setdefault(tag, set()).add(key)
+                self._evict()
+        return entry
+
+    def respond(self, request, page, envelope):
+        """
+        Response for `page` wrapped in `envelope` (the uncached keys). Answers
+        304 when the client already holds this exact body.
+        """
+        etag, body = self.render(page, envelope, request.if_none_match)
+        if body is None:
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype="application/json")
+
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        return response
+
+    def render(self, page, envelope, if_none_match=()):
+        """
+        (etag, body) of `page` wrapped in `envelope`; body is None when the
+        ETag is in `if_none_match`
+        """
+        etag = hashlib.sha1(page.digest.encode("ascii") + dumps(envelope)).hexdigest()
+        if etag in if_none_match:
+            return etag, None
+
+        body = page.body if page.etag == etag else None
+        if body is None:
+            payload = dict(envelope, questions=page.questions, next_cursor=page.next_cursor)
+            with timed("serialize"):
+                body = dumps(payload)
+            page.etag, page.body = etag, body
+        return etag, body
+
+    def invalidate(self, tag):
+        with self._lock:
+            self._generations[tag] = self._generations.get(tag, 0) + 1
+            self._invalidated_at[tag] = time.monotonic()
+            for key in self._tags.pop(tag, ()):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._cleared_at = time.monotonic()
+            self._entries.clear()
+            self._tags.clear()
+            self._bytes = 0
+
+    def _settled(self, tags):
+        # True when the replicas have had REPLICA_MAX_LAG to catch up with the
+        # last write to every tag
+        since = time.monotonic() - current_app.config.get("REPLICA_MAX_LAG", 0)
+        written = [self._invalidated_at.get(tag) for tag in tags] + [self._cleared_at]
+        return all(at is None or at <= since for at in written)
+
+    def _generations_of(self, tags):
+        return [self._epoch] + [self._generations.get(tag, 0) for tag in tags]
+
+    def _remove(self, key):
+        cached = self._entries.pop(key, None)
+        if cached is None:
+            return
+        entry, tags = cached
+        self._bytes -= entry.size
+        # Keys are client input (pages, cursors): the tag index must not outlive them
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def _evict(self):
+        config = current_app.config
+        while self._entries and (
+            len(self._entries) > config["RESPONSE_CACHE_ENTRIES"] or self._bytes > config["RESPONSE_CACHE_BYTES"]
+        ):
+            self._remove(next(iter(self._entries)))
+
+"""
+page_key(request)
+    the part of a listing's cache key that selects the page
+"""
+def page_key(request):
+    cursor = request.args.get("cursor", None, type=str)
+    if cursor:
+        return ("cursor", cursor)
+    return ("page", request.args.get("page", 1, type=int))
+
+def response_cache():
+    return current_app.extensions["response_cache"]
+
+def _on_question_write(event, row, previous):
+    cache = current_app.extensions.get("response_cache")
+    if cache is None:
+        return
+    if event == "reset":
+        cache.clear()
+        return
+    cache.invalidate("questions")
+    for written in (row, previous):
+        if written is not None:
+            cache.invalidate(("category", category_key(written["category"])))
+
+on_write(Question.__tablename__, _on_question_write)
@@ -0,0 +1,167 @@
+import re
+import threading
+
+from flask import current_app
+from sqlalchemy import func, or_, text
+
+from models import db, Question
+from .pagination import QUESTIONS_PER_PAGE, encode_cursor, page_offset
+from .replicas import primary
+from .serializers import project_questions, question_dict, question_dicts
+from .streaming import STREAM_BATCH_SIZE
+
+"""
+search_tokens(term)
+    lower-cased words of a search term; each one is matched as a prefix so
+    partially typed words still find their questions
+"""
+def search_tokens(term):
+    return re.findall(r"\w+", (term or "").lower())
+
+"""
+QuestionSearch
+    relevance-ranked, paginated search over question and answer text.
+    SEARCH_BACKEND selects the engine: "auto" (default) uses Postgres full
+    text search or SQLite FTS5 depending on the database, "like" keeps the
+    unindexed ILIKE scan, which is also the fallback for other databases and
+    for SQLite databases the search migration has not given an FTS5 table.
+"""
+class QuestionSearch:
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._backend = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("SEARCH_BACKEND", "auto")
+        app.extensions["question_search"] = self
+
+    @property
+    def backend(self):
+        with self._lock:
+            if self._backend is None:
+                # Looked for on the primary, which the migrations ran against
+                with primary():
+                    self._backend = self._prepare()
+            return self._backend
+
+    def paginate(self, request, term, per_page=QUESTIONS_PER_PAGE):
+        """Returns (questions, next_cursor, total) for one page of matches."""
+        tokens = search_tokens(term)
+        if not tokens:
+            return [], None, 0
+
+        offset = page_offset(request, per_page)
+        search = getattr(self, "_search_" + self.backend)
+        questions, total = search(tokens, offset, per_page)
+        next_cursor = encode_cursor(offset + per_page) if offset + per_page < total else None
+
+        return question_dicts(questions), next_cursor, total
+
+    def iterate(self, term, batch_size=STREAM_BATCH_SIZE):
+        """
+        Returns (total, questions) where `questions` lazily yields every
+        match in rank order, fetched `batch_size` rows at a time.
+        """
+        tokens = search_tokens(term)
+        if not tokens:
+            return 0, iter(())
+
+        total, questions = getattr(self, "_iterate_" + self.backend)(tokens, batch_size)
+        return total, (question_dict(question) for question in questions)
+
+    def _prepare(self):
+        # The index itself is created by the migrations (flask db upgrade)
+        if current_app.config["SEARCH_BACKEND"] != "auto":
+            return "like"
+        dialect = db.engine.dialect.name
+        if dialect == "postgresql":
+            if db.session.execute(text("SELECT to_regclass('ix_questions_search')")).scalar() is None:
+                current_app.logger.warning("ix_questions_search is missing (run flask db upgrade); searches scan the table")
+            return "postgresql"
+        if dialect == "sqlite":
+            if db.session.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'questions_fts'")).scalar():
+                return "sqlite"
+            current_app.logger.warning("questions_fts is missing (run flask db upgrade, with FTS5); searching with LIKE")
+        return "like"
+
+    def _postgresql_matches(self, tokens):
+        document = func.to_tsvector(
+            "simple",
+            func.coalesce(Question.question, "") + " " + func.coalesce(Question.answer, ""),
+        )
+        query = func.to_tsquery("simple", " & ".join(token + ":*" for token in tokens))
+        matches = Question.query.filter(document.op("@@")(query))
+        return matches, matches.order_by(func.ts_rank(document, query).desc(), Question.id)
+
+    def _search_postgresql(self, tokens, offset, limit):
+        matches, ranked = self._postgresql_matches(tokens)
+        return project_questions(ranked).offset(offset).limit(limit).all(), matches.count()
+
+    def _iterate_postgresql(self, tokens, batch_size):
+        matches, ranked = self._postgresql_matches(tokens)
+        rows = project_questions(ranked).execution_options(stream_results=True).yield_per(batch_size)
+        return matches.count(), rows
+
+    def _sqlite_match(self, tokens):
+        return " ".join('"{}"*'.format(token) for token in tokens)
+
+    def _sqlite_count(self, match):
+        return db.session.execute(
+            text("SELECT count(*) FROM questions_fts WHERE questions_fts MATCH :match"),
+            {"match": match},
+        ).scalar()
+
+    def _sqlite_rows(self, ids):
+        rows = project_questions(Question.query.filter(Question.id.in_(ids))) if ids else []
+        by_id = {row.id: row for row in rows}
+        return [by_id[question_id] for question_id in ids if question_id in by_id]
+
+    def _search_sqlite(self, tokens, offset, limit):
+        match = self._sqlite_match(tokens)
+        ids = [row[0] for row in db.session.execute(
+            text(
+                "SELECT rowid FROM questions_fts WHERE questions_fts MATCH :match "
+                "ORDER BY rank, rowid LIMIT :limit OFFSET :offset"
+            ),
+            {"match": match, "limit": limit, "offset": offset},
+        )]
+        return self._sqlite_rows(ids), self._sqlite_count(match)
+
+    def _iterate_sqlite(self, tokens, batch_size):
+        match = self._sqlite_match(tokens)
+
+        def rows():
+            result = db.session.execute(
+                text("SELECT rowid FROM questions_fts WHERE questions_fts MATCH :match ORDER BY rank, rowid"),
+                {"match": match},
+            )
+            while True:
+                ids = [row[0] for row in result.fetchmany(batch_size)]
+                if not ids:
+                    break
+                for question in self._sqlite_rows(ids):
+                    yield question
+
+        return self._sqlite_count(match), rows()
+
+    def _like_matches(self, tokens):
+        matches = Question.query
+        for token in tokens:
+            pattern = "%{}%".format(token)
+            matches = matches.filter(or_(Question.question.ilike(pattern), Question.answer.ilike(pattern)))
+        return matches, matches.order_by(Question.id)
+
+    def _search_like(self, tokens, offset, limit):
+        matches, ranked = self._like_matches(tokens)
+        return project_questions(ranked).offset(offset).limit(limit).all(), matches.count()
+
+    def _iterate_like(self, tokens, batch_size):
+        matches, ranked = self._like_matches(tokens)
+        rows = project_questions(ranked).execution_options(stream_results=True).yield_per(batch_size)
+        return matches.count(), rows
+
+def question_search():
+    return current_app.extensions["question_search"]
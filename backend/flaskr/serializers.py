@@ -0,0 +1,50 @@
+import json
+
+from flask import Response
+
+from models import Question
+from .instrumentation import timed
+
+try:
+    import orjson
+except ImportError: # in requirements.txt; the stdlib encoder covers installs without it
+    orjson = None
+
+"""
+Read path without ORM hydration.
+Read-only endpoints select just these columns as plain tuples and build the
+response dicts from them directly, skipping the identity map, attribute
+instrumentation and Question.format().
+"""
+QUESTION_COLUMNS = (Question.id, Question.question, Question.answer, Question.category, Question.difficulty)
+QUESTION_KEYS = tuple(column.key for column in QUESTION_COLUMNS)
+
+def project_questions(selection):
+    return selection.with_entities(*QUESTION_COLUMNS)
+
+def question_dict(row):
+    return dict(zip(QUESTION_KEYS, row))
+
+def question_dicts(rows):
+    return [dict(zip(QUESTION_KEYS, row)) for row in rows]
+
+"""
+dumps(payload)
+    encodes a response payload to UTF-8 bytes with orjson (a requirement),
+    or with the stdlib encoder where it is missing
+"""
+if orjson is not None:
+    def dumps(payload):
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+else:
+    def dumps(payload):
+        return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+"""
+json_response(payload, status)
+    drop-in replacement for jsonify() on read-only endpoints
+"""
+def json_response(payload, status=200):
+    with timed("serialize"):
+        body = dumps(payload)
+    return Response(body, status=status, mimetype="application/json")
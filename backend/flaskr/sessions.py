@@ -0,0 +1,157 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+SET_ENTRY_BYTES = 64 # Rough cost of one id in a set: the entry plus the int
+
+"""
+SeenSet
+    question ids a session has served: a plain set while that is the
+    smaller, then a bitset backed by a bytearray with one bit per id from
+    the lowest id seen. A session that has seen a few questions holds a
+    few hundred bytes however far apart their ids are; one that has seen
+    every question of a 100k bank ~12KB.
+    Supports `in`, iteration and len() like the set it replaces.
+"""
+class SeenSet:
+
+    def __init__(self, ids=()):
+        self._ids = set()
+        self._bits = None
+        self._base = 0 # Id of the first bit, a multiple of 8
+        self._low = self._high = None
+        self._count = 0
+        for question_id in ids:
+            self.add(question_id)
+
+    def __contains__(self, question_id):
+        if self._bits is None:
+            return question_id in self._ids
+        offset = question_id - self._base
+        byte = offset >> 3
+        return 0 <= byte < len(self._bits) and bool(self._bits[byte] & (1 << (offset & 7)))
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        if self._bits is None:
+            yield from list(self._ids)
+            return
+        for byte, value in enumerate(self._bits):
+            while value:
+                low = value & -value
+                yield self._base + (byte << 3) + low.bit_length() - 1
+                value ^= low
+
+    def add(self, question_id):
+        if question_id in self:
+            return
+        self._count += 1
+        self._low = question_id if self._low is None else min(self._low, question_id)
+        self._high = question_id if self._high is None else max(self._high, question_id)
+        base = self._low & ~7
+        size = ((self._high - base) >> 3) + 1
+        if self._count * SET_ENTRY_BYTES <= size:
+            # Sparse: a set is smaller, also after a far away id
+            if self._bits is not None:
+                self._ids = set(self)
+                self._bits = None
+            self._ids.add(question_id)
+            return
+
+        if self._bits is None:
+            ids, self._ids = self._ids, None
+            self._base, self._bits = base, bytearray(size)
+            for seen_id in ids:
+                self._set(seen_id)
+        elif base < self._base:
+            self._bits[:0] = bytes((self._base - base) >> 3)
+            self._base = base
+        if size > len(self._bits):
+            self._bits.extend(bytes(size - len(self._bits)))
+        self._set(question_id)
+
+    def _set(self, question_id):
+        offset = question_id - self._base
+        self._bits[offset >> 3] |= 1 << (offset & 7)
+
+"""
+QuizSession
+    server-side state of one quiz: the category and difficulties being
+    played, the questions already served and when the session expires
+"""
+class QuizSession:
+
+    def __init__(self, token, category_id, expires_at, difficulties=None):
+        self.token = token
+        self.category_id = category_id
+        self.difficulties = difficulties
+        self.seen = SeenSet()
+        self.expires_at = expires_at
+        self.lock = threading.Lock()
+
+"""
+QuizSessionStore
+    in-process quiz sessions ordered by last use. Sessions idle for longer
+    than QUIZ_SESSION_TTL seconds are evicted lazily on every access, and the
+    least recently used ones are dropped beyond QUIZ_SESSION_LIMIT.
+    Not shared between worker processes: several workers need sticky
+    routing for sessions (see the README).
+"""
+class QuizSessionStore:
+
+    def __init__(self, app=None, clock=time.monotonic):
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._clock = clock
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("QUIZ_SESSION_TTL", 30 * 60)
+        app.config.setdefault("QUIZ_SESSION_LIMIT", 100000)
+        app.extensions["quiz_sessions"] = self
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def start(self, category_id, difficulties=None):
+        with self._lock:
+            now = self._clock()
+            self._evict(now)
+            token = secrets.token_urlsafe(16)
+            session = QuizSession(token, category_id, now + current_app.config["QUIZ_SESSION_TTL"], difficulties)
+            self._sessions[token] = session
+            while len(self._sessions) > current_app.config["QUIZ_SESSION_LIMIT"]:
+                self._sessions.popitem(last=False)
+            return session
+
+    def get(self, token):
+        """Live session for `token` (its TTL restarts), or None."""
+        with self._lock:
+            now = self._clock()
+            self._evict(now)
+            session = self._sessions.get(token)
+            if session is not None:
+                session.expires_at = now + current_app.config["QUIZ_SESSION_TTL"]
+                self._sessions.move_to_end(token)
+            return session
+
+    def end(self, token):
+        with self._lock:
+            return self._sessions.pop(token, None)
+
+    def _evict(self, now):
+        # Sessions are kept in last-use order, so expired ones are at the front
+        while self._sessions:
+            token, session = next(iter(self._sessions.items()))
+            if session.expires_at > now:
+                break
+            del self._sessions[token]
+
+def quiz_sessions():
+    return current_app.extensions["quiz_sessions"]
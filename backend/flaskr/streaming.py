@@ -0,0 +1,43 @@
+from flask import Response, stream_with_context
+
+from .instrumentation import timed
+from .serializers import dumps, project_questions, question_dict
+
+STREAM_BATCH_SIZE = 500 # Rows fetched per round-trip while streaming
+
+"""
+wants_stream(request)
+    True when the client asked for the whole listing as a stream (?stream=true)
+"""
+def wants_stream(request):
+    return request.args.get("stream", "false").lower() in ("1", "true", "yes")
+
+"""
+stream_rows(selection)
+    iterates the question columns of a Question query through a server-side
+    cursor, `batch_size` rows at a time, yielding one dict per row
+"""
+def stream_rows(selection, batch_size=STREAM_BATCH_SIZE):
+    rows = project_questions(selection).execution_options(stream_results=True).yield_per(batch_size)
+    for row in rows:
+        yield question_dict(row)
+
+"""
+stream_json(envelope, key, items)
+    JSON response equal to `envelope` with `key` set to the list of `items`,
+    written item by item as the generator produces them, so the body is never
+    held in memory and the first byte goes out before the last row is read.
+"""
+def stream_json(envelope, key, items):
+    def generate():
+        head = dumps(envelope)[:-1]
+        yield head + (b"," if envelope else b"") + dumps(key) + b":["
+        first = True
+        for item in items:
+            with timed("serialize"):
+                chunk = (b"" if first else b",") + dumps(item)
+            yield chunk
+            first = False
+        yield b"]}"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
@@ -0,0 +1,375 @@
+import heapq
+import threading
+from bisect import bisect_left
+from itertools import chain, islice
+
+from flask import current_app
+
+from models import db, on_write, Question
+from .replicas import primary
+from .search import search_tokens
+
+SUGGEST_KEYS = ("id", "question", "category", "difficulty") # Never the answer
+MIN_DELTA = 16 # Fewest pending keys of a word, or vocabulary changes, worth a merge
+
+"""
+prefix_range(words, prefix)
+    (lo, hi) bounds of the entries of a sorted list of words that start with
+    `prefix`, found with two binary searches
+"""
+def prefix_range(words, prefix):
+    lo = bisect_left(words, prefix)
+    hi = bisect_left(words, prefix + "\U0010ffff", lo)
+    return lo, hi
+
+def prefixes(words):
+    return set(word[:end] for word in words for end in range(1, len(word) + 1))
+
+def rank_key(question):
+    # Shorter questions first, then older ones
+    return (len(question["question"] or ""), question["id"])
+
+"""
+PrefixIndex
+    the data behind SuggestIndex. Under each word, the rank keys of the
+    questions using it, in rank order; under each prefix of a word, the best
+    `k` rank keys of the questions with a word starting with it.
+    Lists are replaced, never changed in place, so a reader can rank from a
+    snapshot of them without a lock. To keep writes cheap:
+    - a word's new keys go to a short list of their own, merged into the
+      word's list once it outgrows the square root of its length, and new
+      words likewise wait in `new_words` before joining the vocabulary
+    - removed questions leave their keys behind (readers check them against
+      `questions`); a word's list drops them once they are half of it
+    - a prefix whose best lost a key is only marked stale, and recomputed
+      from its word and the prefixes one character longer when it is next
+      asked for (refresh)
+"""
+class PrefixIndex:
+
+    def __init__(self, rows, k):
+        self.k = k
+        self.questions = {}
+        self.words = {}
+        self.added = {}
+        self.dead = {}
+        self.new_words = []
+        self.dropped_words = 0
+        self.stale = set()
+        for question in rows:
+            words = frozenset(search_tokens(question["question"]))
+            key = rank_key(question)
+            self.questions[question["id"]] = (question, words, key)
+            for word in words:
+                self.words.setdefault(word, []).append(key)
+        for keys in self.words.values():
+            keys.sort()
+        self.vocabulary = sorted(self.words)
+
+        # Bottom-up, longest prefixes first: a prefix's best keys are the best
+        # of its own word's and those of the prefixes one character longer.
+        # Lists are never changed in place, so a prefix with a single source
+        # shares its list.
+        self.best = {}
+        pending = {}
+        for prefix in sorted(prefixes(self.vocabulary), key=len, reverse=True):
+            sources = pending.pop(prefix, [])
+            if prefix in self.words:
+                sources.append(self.words[prefix][:k])
+            if len(sources) == 1:
+                best = sources[0]
+            else:
+                best = sorted(set(chain(*sources)))[:k]
+            self.best[prefix] = best
+            if len(prefix) > 1:
+                pending.setdefault(prefix[:-1], []).append(best)
+
+    def __len__(self):
+        return len(self.questions)
+
+    def is_live(self, key, word=None):
+        """Whether `key` is a current question's (using `word`)."""
+        indexed = self.questions.get(key[1])
+        return indexed is not None and indexed[2] == key and (word is None or word in indexed[1])
+
+    def postings(self, word):
+        """Keys under `word` in rank order, removed questions' included."""
+        added = self.added.get(word)
+        if added is None:
+            return self.words.get(word, ())
+        return heapq.merge(self.words.get(word, ()), added)
+
+    def vocabulary_range(self, prefix):
+        """Words starting with `prefix`, in no particular order."""
+        for words in (self.vocabulary, self.new_words):
+            lo, hi = prefix_range(words, prefix)
+            for i in range(lo, hi):
+                yield words[i]
+
+    def size(self, prefix):
+        """Entries under `prefix`, to pick the term's rarest word."""
+        words, added = self.words, self.added
+        return sum(len(words.get(word, ())) + len(added.get(word, ())) for word in self.vocabulary_range(prefix))
+
+    def candidates(self, prefix):
+        """
+        (ranked, key) for the questions with a word starting with `prefix`:
+        those with the word itself and then the prefix's stored best, in rank
+        order (ranked is True), then, when the best was cut at k, the rest in
+        no particular order. Lazy, so a term answered from the stored best
+        reads just two short lists. Removed questions' keys are skipped.
+        """
+        words, added, best = self.words, self.added, self.best.get(prefix, ())
+        yielded = set()
+        ranked = chain(
+            ((key, prefix) for key in self.postings(prefix)),
+            ((key, None) for key in best),
+        )
+        for key, word in ranked:
+            if key not in yielded and self.is_live(key, word):
+                yielded.add(key)
+                yield True, key
+        if len(best) < self.k:
+            return
+        for word in self.vocabulary_range(prefix):
+            for key in chain(words.get(word, ()), added.get(word, ())):
+                if key not in yielded and self.is_live(key, word):
+                    yielded.add(key)
+                    yield False, key
+
+    def add_many(self, rows):
+        by_word = {}
+        for row in rows:
+            question = {key: row[key] for key in SUGGEST_KEYS}
+            words = frozenset(search_tokens(question["question"]))
+            key = rank_key(question)
+            self.questions[question["id"]] = (question, words, key)
+            for word in words:
+                by_word.setdefault(word, []).append(key)
+
+        new_words = []
+        by_prefix = {}
+        for word, keys in by_word.items():
+            keys.sort()
+            if word not in self.words and word not in self.added and not self._known(word):
+                new_words.append(word)
+            self.added[word] = sorted(chain(self.added.get(word, ()), keys))
+            if len(self.added[word]) > max(MIN_DELTA, int(len(self.words.get(word, ())) ** 0.5)):
+                self._compact(word)
+            for end in range(1, len(word) + 1):
+                by_prefix.setdefault(word[:end], []).append(keys)
+        if new_words:
+            self.new_words = sorted(chain(self.new_words, new_words))
+            self._check_vocabulary()
+
+        for prefix, sources in by_prefix.items():
+            best = self.best.get(prefix, ())
+            if len(best) < self.k or min(keys[0] for keys in sources) < best[-1]:
+                self.best[prefix] = sorted(set(chain(best, *sources)))[:self.k]
+
+    def remove_many(self, question_ids):
+        touched = set()
+        for question_id in question_ids:
+            indexed = self.questions.pop(question_id, None)
+            if indexed is None:
+                continue
+            question, words, key = indexed
+            for word in words:
+                self.dead[word] = self.dead.get(word, 0) + 1
+                touched.add(word)
+            for prefix in prefixes(words):
+                best = self.best.get(prefix, ())
+                i = bisect_left(best, key)
+                if i < len(best) and best[i] == key:
+                    self.stale.add(prefix)
+        for word in touched:
+            if self.dead.get(word, 0) * 2 > len(self.words.get(word, ())) + len(self.added.get(word, ())):
+                self._compact(word)
+
+    def refresh(self, prefix):
+        """The stored best of `prefix`, first recomputed if it is stale."""
+        if prefix not in self.stale:
+            return self.best.get(prefix, ())
+        self.stale.discard(prefix)
+        sources = [islice(self._live_keys(self.postings(prefix), prefix), self.k)]
+        sources.extend(self.refresh(child) for child in self._children(prefix))
+        best = sorted(set(chain(*sources)))[:self.k]
+        if best:
+            self.best[prefix] = best
+        else:
+            self.best.pop(prefix, None)
+        return best
+
+    def _children(self, prefix):
+        # The prefixes one character longer, skipping over the words under each
+        children = set()
+        for words in (self.vocabulary, self.new_words):
+            lo, hi = prefix_range(words, prefix)
+            while lo < hi:
+                if len(words[lo]) == len(prefix):
+                    lo += 1
+                    continue
+                child = words[lo][:len(prefix) + 1]
+                children.add(child)
+                lo = bisect_left(words, child + "\U0010ffff", lo, hi)
+        return children
+
+    def _compact(self, word):
+        # The word's keys in one list, without removed questions'. Sorting the
+        # two sorted runs merges them in linear time.
+        keys = sorted(chain(self.words.get(word, ()), self.added.get(word, ())))
+        if self.dead.get(word):
+            keys = list(self._live_keys(keys, word))
+        if keys:
+            self.words[word] = keys
+        else:
+            self.words.pop(word, None)
+        self.added.pop(word, None)
+        self.dead.pop(word, None)
+        if not keys:
+            self.dropped_words += 1
+            self._check_vocabulary()
+
+    def _live_keys(self, keys, word):
+        # Skips removed questions' keys, and the second copy of a question
+        # updated without changing its key
+        questions, last = self.questions, None
+        for key in keys:
+            indexed = questions.get(key[1])
+            if key != last and indexed is not None and indexed[2] == key and word in indexed[1]:
+                yield key
+            last = key
+
+    def _known(self, word):
+        # In the vocabulary already, e.g. a word whose questions were all removed
+        for words in (self.vocabulary, self.new_words):
+            i = bisect_left(words, word)
+            if i < len(words) and words[i] == word:
+                return True
+        return False
+
+    def _check_vocabulary(self):
+        if len(self.new_words) + self.dropped_words > max(MIN_DELTA, int(len(self.vocabulary) ** 0.5)):
+            words, added = self.words, self.added
+            kept = self.vocabulary
+            if self.dropped_words:
+                kept = [word for word in kept if word in words or word in added]
+            self.vocabulary = sorted(chain(kept, (word for word in self.new_words if word in words or word in added)))
+            self.new_words = []
+            self.dropped_words = 0
+
+"""
+SuggestIndex
+    in-memory typeahead index over question text (a PrefixIndex). The best
+    SUGGEST_MAX_LIMIT questions of every prefix are kept ahead of time, so a
+    one-word term reads two short lists and never touches the database.
+    Built with a single query on first use (the async app warms it at
+    startup) and kept up to date by Question.insert(), update() and delete(),
+    and a batch at a time by insert_many() and delete_many(). A write costs
+    about the square root of its words' list lengths, not their lengths.
+
+    Every word of the term is matched as a prefix. Candidates come from the
+    word with the fewest entries, best first, and are checked against the
+    others until `limit` match or SUGGEST_SCAN_LIMIT have been checked.
+    Exact word matches rank first, then shorter questions; past the word's
+    stored best, matches are ranked among themselves only, so a term of
+    several common words may miss a better match.
+"""
+class SuggestIndex:
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._index = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("SUGGEST_LIMIT", 10)
+        app.config.setdefault("SUGGEST_MAX_LIMIT", 50)
+        app.config.setdefault("SUGGEST_SCAN_LIMIT", 1000)
+        app.extensions["suggest_index"] = self
+
+    def __len__(self):
+        with self._lock:
+            return len(self._load())
+
+    def reset(self):
+        with self._lock:
+            self._index = None
+
+    def suggest(self, term, limit=None):
+        """Up to `limit` question dicts (without answers) matching `term`."""
+        config = current_app.config
+        limit = min(max(limit or config["SUGGEST_LIMIT"], 1), config["SUGGEST_MAX_LIMIT"])
+        tokens = sorted(set(search_tokens(term)))
+        if not tokens:
+            return []
+
+        # Ranked outside the lock: writes never change a list in place
+        with self._lock:
+            index = self._load()
+        rarest = min(tokens, key=index.size) if len(tokens) > 1 else tokens[0]
+        if rarest in index.stale:
+            with self._lock:
+                index.refresh(rarest)
+
+        ranked, unranked = [], []
+        for scanned, (in_order, key) in enumerate(index.candidates(rarest)):
+            if scanned == config["SUGGEST_SCAN_LIMIT"] or len(ranked) + len(unranked) == limit:
+                break
+            indexed = index.questions.get(key[1])
+            if indexed is None or indexed[2] != key:
+                # Removed, or reindexed under another key, since the ranking started
+                continue
+            question, words, _ = indexed
+            if all(any(word.startswith(token) for word in words) for token in tokens):
+                (ranked if in_order else unranked).append((key, question))
+        unranked.sort(key=lambda match: match[0])
+        return [question for key, question in (ranked + unranked)[:limit]]
+
+    def apply(self, event, row, previous=None):
+        with self._lock:
+            if self._index is None:
+                return
+            if event == "reset":
+                self._index = None
+                return
+            if event in ("delete", "update"):
+                old = previous if previous is not None else row
+                self._index.remove_many([old["id"]])
+            if event in ("insert", "update"):
+                self._index.add_many([row])
+
+    def apply_many(self, event, rows):
+        with self._lock:
+            if self._index is None:
+                return
+            if event == "insert":
+                self._index.add_many(rows)
+            elif event == "delete":
+                self._index.remove_many([row["id"] for row in rows])
+
+    def _load(self):
+        if self._index is None:
+            with primary():
+                rows = db.session.query(*(getattr(Question, key) for key in SUGGEST_KEYS)).order_by(Question.id)
+                self._index = PrefixIndex(
+                    [dict(zip(SUGGEST_KEYS, values)) for values in rows],
+                    current_app.config["SUGGEST_MAX_LIMIT"],
+                )
+        return self._index
+
+def suggest_index():
+    return current_app.extensions["suggest_index"]
+
+def _on_question_write(event, row, previous):
+    index = current_app.extensions.get("suggest_index")
+    if index is not None:
+        index.apply(event, row, previous)
+
+def _on_question_writes(event, rows):
+    index = current_app.extensions.get("suggest_index")
+    if index is not None:
+        index.apply_many(event, rows)
+
+on_write(Question.__tablename__, _on_question_write, many=_on_question_writes)
@@ -0,0 +1,42 @@
+"""integer category foreign key and (category, difficulty) index
+
+Revision ID: d4b2f9e81c07
+Revises: a1c3e5f70b21
+Create Date: 2026-10-17 09:31:05.402677
+
+questions.category becomes an integer foreign key to categories.id, so the
+integer category ids the API filters by compare without a cast, and the
+composite index serves both category-only and category + difficulty
+filters. Every existing category value must be the id of a category.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4b2f9e81c07'
+down_revision = 'a1c3e5f70b21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('questions') as batch_op:
+        batch_op.alter_column('category',
+               existing_type=sa.String(),
+               type_=sa.Integer(),
+               existing_nullable=True,
+               postgresql_using='category::integer')
+        batch_op.create_foreign_key('fk_questions_category_categories', 'categories', ['category'], ['id'])
+        batch_op.create_index('ix_questions_category_difficulty', ['category', 'difficulty'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('questions') as batch_op:
+        batch_op.drop_index('ix_questions_category_difficulty')
+        batch_op.drop_constraint('fk_questions_category_categories', type_='foreignkey')
+        batch_op.alter_column('category',
+               existing_type=sa.Integer(),
+               type_=sa.String(),
+               existing_nullable=True,
+               postgresql_using='category::text')
@@ -0,0 +1,67 @@
+"""full text search index over question and answer text
+
+Revision ID: f3a8d61b29c4
+Revises: d4b2f9e81c07
+Create Date: 2026-10-17 14:02:51.730214
+
+On Postgres a GIN index over the same tsvector expression the search query
+uses, so the planner can match it, built CONCURRENTLY so writes to
+questions go on meanwhile. On SQLite an external-content FTS5 table kept in
+sync with questions by triggers, filled from the existing rows; skipped
+when SQLite is built without FTS5 (search then falls back to LIKE).
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3a8d61b29c4'
+down_revision = 'd4b2f9e81c07'
+branch_labels = None
+depends_on = None
+
+POSTGRES_INDEX = """
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_questions_search ON questions
+USING GIN (to_tsvector('simple', coalesce(question, '') || ' ' || coalesce(answer, '')))
+"""
+
+SQLITE_FTS = [
+    """CREATE VIRTUAL TABLE questions_fts
+       USING fts5(question, answer, content='questions', content_rowid='id')""",
+    """CREATE TRIGGER questions_fts_ai AFTER INSERT ON questions BEGIN
+         INSERT INTO questions_fts(rowid, question, answer) VALUES (new.id, new.question, new.answer);
+       END""",
+    """CREATE TRIGGER questions_fts_ad AFTER DELETE ON questions BEGIN
+         INSERT INTO questions_fts(questions_fts, rowid, question, answer) VALUES ('delete', old.id, old.question, old.answer);
+       END""",
+    """CREATE TRIGGER questions_fts_au AFTER UPDATE ON questions BEGIN
+         INSERT INTO questions_fts(questions_fts, rowid, question, answer) VALUES ('delete', old.id, old.question, old.answer);
+         INSERT INTO questions_fts(rowid, question, answer) VALUES (new.id, new.question, new.answer);
+       END""",
+    "INSERT INTO questions_fts(questions_fts) VALUES ('rebuild')",
+]
+
+
+def has_fts5(bind):
+    return bool(bind.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')").scalar())
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        # CONCURRENTLY cannot run inside the migration's transaction
+        with op.get_context().autocommit_block():
+            op.execute(POSTGRES_INDEX)
+    elif bind.dialect.name == 'sqlite' and has_fts5(bind):
+        for statement in SQLITE_FTS:
+            op.execute(statement)
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_questions_search")
+    elif bind.dialect.name == 'sqlite':
+        for trigger in ('questions_fts_ai', 'questions_fts_ad', 'questions_fts_au'):
+            op.execute("DROP TRIGGER IF EXISTS {}".format(trigger))
+        op.execute("DROP TABLE IF EXISTS questions_fts")
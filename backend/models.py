@@ -1,6 +1,14 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import random
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import Column, String, Integer, ForeignKey, Index, create_engine, inspect
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy import orm
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from flask_migrate import Migrate
 import json
 
 from dotenv import load_dotenv
@@ -11,32 +19,228 @@ DB_PASSWORD = os.getenv('DB_PASSWORD')
 DB_HOST = os.getenv('DB_HOST')
 DB_PORT = os.getenv('DB_PORT')
 DB_NAME = os.getenv('DB_NAME')
-database_path = 'postgresql://{}:{}@{}:{}/{}'.format(DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_NAME)
+# DATABASE_URL (any SQLAlchemy URL, e.g. sqlite:///trivia.db) overrides the DB_* settings
+database_path = os.getenv('DATABASE_URL') or 'postgresql://{}:{}@{}:{}/{}'.format(DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_NAME)
+# Connection pool; unset values keep SQLAlchemy's defaults
+DB_POOL_SIZE = os.getenv('DB_POOL_SIZE')
+DB_MAX_OVERFLOW = os.getenv('DB_MAX_OVERFLOW')
+DB_POOL_TIMEOUT = os.getenv('DB_POOL_TIMEOUT')
+DB_POOL_RECYCLE = os.getenv('DB_POOL_RECYCLE')
+DB_POOL_PRE_PING = (os.getenv('DB_POOL_PRE_PING') or '').lower() in ('1', 'true', 'yes')
+# Read replicas: a comma separated DB_REPLICA_HOST list (same credentials and
+# database name as DB_HOST), or REPLICA_DATABASE_URL with SQLAlchemy URLs
+DB_REPLICA_HOST = os.getenv('DB_REPLICA_HOST')
+DB_REPLICA_PORT = os.getenv('DB_REPLICA_PORT') or DB_PORT
+if os.getenv('REPLICA_DATABASE_URL'):
+    replica_paths = os.getenv('REPLICA_DATABASE_URL').split(',')
+elif DB_REPLICA_HOST:
+    replica_paths = ['postgresql://{}:{}@{}:{}/{}'.format(DB_USER, DB_PASSWORD, host.strip(), DB_REPLICA_PORT, DB_NAME) for host in DB_REPLICA_HOST.split(',')]
+else:
+    replica_paths = []
+# Set when connecting through PgBouncer in transaction pooling mode
+DB_PGBOUNCER = (os.getenv('DB_PGBOUNCER') or '').lower() in ('1', 'true', 'yes')
+migrations_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
 
-db = SQLAlchemy()
+"""
+RoutingSession
+    session that sends its queries to a read replica (a "replica_N" bind)
+    while `use_replica` is set, and to the primary otherwise. Flushes always
+    go to the primary. One replica is picked per session, so a request reads
+    a single consistent copy.
+"""
+class RoutingSession(SignallingSession):
+
+    use_replica = False
+
+    def __init__(self, db, **options):
+        self._replica = None
+        SignallingSession.__init__(self, db, **options)
+        self._db = db
+
+    @property
+    def replica_binds(self):
+        return [key for key in self.app.config.get("SQLALCHEMY_BINDS") or {} if key.startswith("replica_")]
+
+    @property
+    def reads_replica(self):
+        return self.use_replica and bool(self.replica_binds)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.use_replica and not self._flushing:
+            replicas = self.replica_binds
+            if replicas:
+                if self._replica is None:
+                    self._replica = random.choice(replicas)
+                return self._db.get_engine(self.app, bind=self._replica)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+db = RoutingSQLAlchemy()
+migrate = Migrate()
+
+"""
+on_pool_checkout(listener)
+    registers listener(seconds, timed_out) to run after every connection
+    checkout from an InstrumentedQueuePool, with the time spent waiting for
+    (or opening) the connection and whether the wait hit pool_timeout
+"""
+pool_listeners = []
+
+def on_pool_checkout(listener):
+    pool_listeners.append(listener)
+    return listener
+
+"""
+InstrumentedQueuePool
+    QueuePool that reports how long each checkout waited to the
+    on_pool_checkout listeners
+"""
+class InstrumentedQueuePool(QueuePool):
+
+    def _do_get(self):
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            for listener in pool_listeners:
+                listener(seconds, timed_out)
+
+"""
+engine_options(database_path)
+    create_engine() options for the DB_POOL_* settings: an instrumented
+    QueuePool sized by DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT and
+    DB_POOL_RECYCLE, with DB_POOL_PRE_PING testing each connection on
+    checkout. With DB_PGBOUNCER no connections are kept here at all and
+    PgBouncer does the pooling.
+    SQLite keeps Flask-SQLAlchemy's pool unless DB_POOL_SIZE is set.
+"""
+def engine_options(database_path):
+    if database_path.startswith('postgres') and DB_PGBOUNCER:
+        return {'poolclass': NullPool}
+    in_memory = database_path in ('sqlite://', 'sqlite:///:memory:')
+    if database_path.startswith('sqlite') and (DB_POOL_SIZE is None or in_memory):
+        return {}
+
+    options = {'poolclass': InstrumentedQueuePool, 'pool_pre_ping': DB_POOL_PRE_PING}
+    for key, value, type in (
+        ('pool_size', DB_POOL_SIZE, int),
+        ('max_overflow', DB_MAX_OVERFLOW, int),
+        ('pool_timeout', DB_POOL_TIMEOUT, float),
+        ('pool_recycle', DB_POOL_RECYCLE, int),
+    ):
+        if value is not None:
+            options[key] = type(value)
+    return options
 
 """
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service.
+    The schema is owned by the Alembic migrations in migrations/ and is
+    created or upgraded with `flask db upgrade`, not at startup.
+    Each of `replica_paths` becomes a "replica_N" bind that RoutingSession
+    reads from; the replicas are expected to be copies of the primary.
 """
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, replica_paths=replica_paths):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
+    app.config["SQLALCHEMY_BINDS"] = {"replica_{}".format(i): path for i, path in enumerate(replica_paths)}
     db.app = app
     db.init_app(app)
-    db.create_all()
+    # Batch mode lets ALTER-heavy migrations run on SQLite too
+    migrate.init_app(app, db, directory=migrations_path, render_as_batch=True)
 
 """
-Question
+on_write(table, listener)
+    registers listener(event, row, previous) to run after a row of `table`
+    has been committed through insert(), update() or delete(). `event` is
+    "insert", "update" or "delete", `row` is the row's format() dict and
+    `previous` is its format() dict before an update (None otherwise).
+    Derived data such as cached counts is kept up to date this way.
+    Bulk writes that bypass the models send a single "reset" event with
+    `row` None, after which derived data must be rebuilt.
+    insert_many() and delete_many() call `many(event, rows)` once for the
+    whole batch instead, when the listener was registered with one.
+"""
+write_listeners = {}
 
+def on_write(table, listener, many=None):
+    write_listeners.setdefault(table, []).append((listener, many))
+    return listener
+
+def notify_write(table, event, row, previous=None):
+    for listener, many in write_listeners.get(table, []):
+        listener(event, row, previous)
+
+def notify_writes(table, event, rows):
+    for listener, many in write_listeners.get(table, []):
+        if many is not None:
+            many(event, rows)
+        else:
+            for row in rows:
+                listener(event, row, None)
+
+"""
+writing(table)
+    wraps the commit of a write to `table` and its notify_write() calls;
+    writes_pending(table) is above 0 meanwhile. Derived data loaded from the
+    database while a write is pending may or may not include it, and its
+    event may still come, so such a load must not be kept.
+"""
+pending_writes = {}
+pending_writes_lock = threading.Lock()
+
+@contextmanager
+def writing(table):
+    with pending_writes_lock:
+        pending_writes[table] = pending_writes.get(table, 0) + 1
+    try:
+        yield
+    finally:
+        with pending_writes_lock:
+            pending_writes[table] -= 1
+
+def writes_pending(table):
+    with pending_writes_lock:
+        return pending_writes.get(table, 0)
+
+"""
+committed_state(instance)
+    format() dict of `instance` as it was before its pending changes
+"""
+def committed_state(instance):
+    previous = instance.format()
+    for attr in inspect(instance).attrs:
+        history = attr.history
+        if history.deleted:
+            previous[attr.key] = history.deleted[0]
+    return previous
+
+"""
+Question
+    insert_many() and delete_many() write a batch of questions in one
+    transaction and notify the listeners of the batch after the commit.
 """
 class Question(db.Model):
     __tablename__ = 'questions'
+    __table_args__ = (
+        # Leading column also serves filters on category alone
+        Index('ix_questions_category_difficulty', 'category', 'difficulty'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey('categories.id', name='fk_questions_category_categories'))
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -47,14 +251,43 @@ class Question(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
+        row = self.format()
+        with writing(self.__tablename__):
+            db.session.commit()
+            notify_write(self.__tablename__, "insert", row)
 
     def update(self):
-        db.session.commit()
+        previous = committed_state(self)
+        row = self.format()
+        with writing(self.__tablename__):
+            db.session.commit()
+            notify_write(self.__tablename__, "update", row, previous)
 
     def delete(self):
+        row = self.format()
         db.session.delete(self)
-        db.session.commit()
+        with writing(self.__tablename__):
+            db.session.commit()
+            notify_write(self.__tablename__, "delete", row)
+
+    @classmethod
+    def insert_many(cls, questions):
+        db.session.add_all(questions)
+        db.session.flush()
+        rows = [question.format() for question in questions]
+        with writing(cls.__tablename__):
+            db.session.commit()
+            notify_writes(cls.__tablename__, "insert", rows)
+
+    @classmethod
+    def delete_many(cls, questions):
+        rows = [question.format() for question in questions]
+        for question in questions:
+            db.session.delete(question)
+        with writing(cls.__tablename__):
+            db.session.commit()
+            notify_writes(cls.__tablename__, "delete", rows)
 
     def format(self):
         return {
@@ -78,6 +311,28 @@ class Category(db.Model):
     def __init__(self, type):
         self.type = type
 
+    def insert(self):
+        db.session.add(self)
+        db.session.flush()
+        row = self.format()
+        with writing(self.__tablename__):
+            db.session.commit()
+            notify_write(self.__tablename__, "insert", row)
+
+    def update(self):
+        previous = committed_state(self)
+        row = self.format()
+        with writing(self.__tablename__):
+            db.session.commit()
+            notify_write(self.__tablename__, "update", row, previous)
+
+    def delete(self):
+        row = self.format()
+        db.session.delete(self)
+        with writing(self.__tablename__):
+            db.session.commit()
+            notify_write(self.__tablename__, "delete", row)
+
     def format(self):
         return {
             'id': self.id,
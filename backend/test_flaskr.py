@@ -1,40 +1,153 @@
 import os
+import re
+import shutil
+import tempfile
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+from flask_migrate import upgrade
+from sqlalchemy import event, orm
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr.asgi import create_asgi_app, databases
+from flaskr.cache_bus import brokers, VERSION_KEY
+from flaskr.counts import question_counts
+from flaskr.pagination import encode_cursor
+from flaskr.response_cache import ResponseCache
+from flaskr.search import question_search
+from flaskr.sessions import SeenSet
+from models import db, notify_write, writing, Question, Category
 
 from dotenv import load_dotenv
 load_dotenv()
 
-class TriviaTestCase(unittest.TestCase):
-    """This class represents the trivia test case"""
+# Any SQLAlchemy URL; the default is a private in-memory database per process
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "sqlite://")
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "trivia.psql")
+
+"""
+load_fixture(path)
+    rows of the COPY blocks of a pg_dump file, as {table name: [row dicts]}
+"""
+def load_fixture(path=FIXTURE_PATH):
+    tables = {}
+    with open(path) as dump:
+        lines = iter(dump.read().splitlines())
+    for line in lines:
+        match = re.match(r"COPY public\.(\w+) \((.*)\) FROM stdin;", line)
+        if match is None:
+            continue
+        table = db.Model.metadata.tables[match.group(1)]
+        columns = match.group(2).split(", ")
+        rows = tables.setdefault(table.name, [])
+        for line in lines:
+            if line == "\\.":
+                break
+            values = line.split("\t")
+            rows.append({
+                column: None if value == "\\N" else table.c[column].type.python_type(value)
+                for column, value in zip(columns, values)
+            })
+    return tables
+
+"""
+create_test_database(app)
+    migrates the app's database to the latest schema and loads trivia.psql
+    into it unless it already has questions
+"""
+def create_test_database(app):
+    with app.app_context():
+        upgrade()
+        if Question.query.count():
+            return
+        fixture = load_fixture()
+        for table in db.Model.metadata.sorted_tables:
+            if fixture.get(table.name):
+                db.session.execute(table.insert(), fixture[table.name])
+                if db.engine.dialect.name == "postgresql":
+                    db.session.execute("SELECT setval(pg_get_serial_sequence('{0}', 'id'), max(id)) FROM {0}".format(table.name))
+        db.session.commit()
+
+def savepoints_for_pysqlite(engine):
+    # pysqlite's own transaction handling breaks SAVEPOINT; let SQLAlchemy emit BEGIN
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def begin(connection):
+        connection.execute("BEGIN")
+
+"""
+RollbackSession
+    stands in for db.session during a test: one session bound to the test's
+    connection. The end of a request only forgets the objects it loaded
+    instead of closing the session and with it the test's transaction.
+"""
+class RollbackSession(orm.scoped_session):
+
+    def remove(self):
+        session = self.registry()
+        if not session.is_active:
+            session.rollback()
+        session.expunge_all()
+
+class DatabaseTestCase(unittest.TestCase):
+    """
+    One app and database per test class: an in-memory SQLite database (or
+    TEST_DATABASE_URL) with the schema created and trivia.psql loaded once.
+    Every test runs in a transaction that is rolled back afterwards, with
+    the app's commits turned into SAVEPOINTs, and the in-process caches are
+    reset, so tests never see each other's writes. pytest-xdist workers are
+    separate processes with separate databases: `python -m pytest -n auto`.
+    """
+    test_config = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(dict({"SQLALCHEMY_DATABASE_URI": TEST_DATABASE_URL}, **cls.test_config))
+        with cls.app.app_context():
+            if db.engine.dialect.name == "sqlite":
+                savepoints_for_pysqlite(db.engine)
+        create_test_database(cls.app)
 
     def setUp(self):
-        """Define test variables and initialize app."""
-        self.app = create_app()
         self.client = self.app.test_client
-        self.DB_USER = os.getenv("DB_USER")
-        self.DB_PASSWORD = os.getenv("DB_PASSWORD")
-        self.DB_HOST = os.getenv("DB_HOST")
-        self.DB_PORT = os.getenv("DB_PORT")
-        self.database_name = os.getenv("TEST_DB_NAME")
-        self.database_path = 'postgresql+psycopg2://{}:{}@{}:{}/{}'.format(self.DB_USER, self.DB_PASSWORD, self.DB_HOST, self.DB_PORT, self.database_name)
-        setup_db(self.app, self.database_path)
-        
-        self.new_question = {"quetion": "What is your hobby?", "answer": "Football", "category": 6, "difficulty": 1}
-        # binds the app to the current context
         with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
-    
+            self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.db_session = db.session
+
+        session = db.create_session({"bind": self.connection, "binds": {}})()
+        session.begin_nested()
+
+        @event.listens_for(session, "after_transaction_end")
+        def restart_savepoint(session, transaction):
+            if transaction.nested and not transaction._parent.nested:
+                session.expire_all()
+                session.begin_nested()
+
+        db.session = RollbackSession(lambda: session)
+
     def tearDown(self):
-        """Executed after each test"""
-        pass
+        db.session.registry().close()
+        db.session = self.db_session
+        self.transaction.rollback()
+        self.connection.close()
+        with self.app.app_context():
+            # Derived data may still hold rows the rollback removed
+            notify_write(Question.__tablename__, "reset", None)
+            notify_write(Category.__tablename__, "reset", None)
+
+class TriviaTestCase(DatabaseTestCase):
+    """This class represents the trivia test case"""
+    # The tests send requests far faster than any client would
+    test_config = {"RATE_LIMIT": False}
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        super().setUp()
+        self.new_question = {"question": "What is your hobby?", "answer": "Football", "category": 6, "difficulty": 1}
+        self.batch_question = {"question": "Which team won the 2014 World Cup?", "answer": "Germany", "category": 6, "difficulty": 2}
 
     """
     Two tests for each route, each test for successful operation and for expected errors.
@@ -49,6 +162,44 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(len(data["questions"]))
         self.assertTrue(len(data["categories"]))
     
+    def test_get_questions_by_cursor(self):
+        first = json.loads(self.client().get("/questions").data)
+        res = self.client().get("/questions?cursor={}".format(first["next_cursor"]))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertTrue(len(data["questions"]))
+        self.assertGreater(data["questions"][0]["id"], first["questions"][-1]["id"])
+
+    def test_400_sent_requesting_invalid_cursor(self):
+        res = self.client().get("/questions?cursor=not-a-cursor")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+
+        res = self.client().get("/categories/1/questions?cursor=not-a-cursor")
+        self.assertEqual(res.status_code, 400)
+
+        res = self.client().post("/questions?cursor=not-a-cursor", json={"search": "a"})
+        self.assertEqual(res.status_code, 400)
+
+    def test_400_sent_requesting_out_of_range_cursor_or_page(self):
+        huge_cursor = encode_cursor(10 ** 23)
+        for path in ("/questions", "/categories/1/questions"):
+            res = self.client().get(path + "?cursor=" + huge_cursor)
+            self.assertEqual(res.status_code, 400)
+            res = self.client().get(path + "?page=" + str(10 ** 20))
+            self.assertEqual(res.status_code, 400)
+
+        res = self.client().post("/questions/search?cursor=" + huge_cursor, json={"searchTerm": "title"})
+        self.assertEqual(res.status_code, 400)
+        res = self.client().post("/questions/search?page=" + str(10 ** 20), json={"searchTerm": "title"})
+        self.assertEqual(res.status_code, 400)
+        res = self.client().post("/questions?cursor=" + huge_cursor, json={"search": "title"})
+        self.assertEqual(res.status_code, 400)
+
     def test_get_paginated_categories(self):
         res = self.client().get("/categories")
         data = json.loads(res.data)
@@ -57,6 +208,45 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data["success"], True)
         self.assertTrue(len(data["categories"]))
     
+    def test_304_sent_for_unchanged_categories(self):
+        first = self.client().get("/categories")
+        res = self.client().get("/categories", headers={"If-None-Match": first.headers["ETag"]})
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(res.status_code, 304)
+
+    def test_server_timing_header(self):
+        res = self.client().get("/questions")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("pool;dur=", res.headers["Server-Timing"])
+        self.assertIn("db;dur=", res.headers["Server-Timing"])
+        self.assertIn("total;dur=", res.headers["Server-Timing"])
+
+    def test_get_metrics(self):
+        self.client().get("/questions")
+        res = self.client().get("/metrics")
+        body = res.data.decode("utf-8")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('trivia_request_duration_seconds_count{endpoint="get_questions"}', body)
+        self.assertIn('trivia_db_queries_total{endpoint="get_questions"}', body)
+        self.assertIn('trivia_db_pool_timeouts_total{pool="default"}', body)
+
+    def test_metrics_include_streamed_bodies(self):
+        def queries():
+            body = self.client().get("/metrics").data.decode("utf-8")
+            match = re.search(r'trivia_db_queries_total\{endpoint="get_question_category"\} (\d+)', body)
+            return int(match.group(1)) if match else 0
+
+        before = queries()
+        res = self.client().get("/categories/1/questions?stream=true")
+        self.assertTrue(json.loads(res.data)["questions"])
+        header = int(re.search(r'"(\d+) queries', res.headers["Server-Timing"]).group(1))
+
+        # The header is sent before the rows are read; the metrics wait for them
+        self.assertGreater(queries() - before, header)
+
     def test_404_sent_requesting_beyond_valid_page(self):
         res = self.client().get("/categories/1000")
         data = json.loads(res.data)
@@ -66,14 +256,14 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data["message"], "resource not found")
     
     def test_delete_question(self):
-        res = self.client().delete("/questions/7")
+        res = self.client().delete("/questions/5")
         data = json.loads(res.data)
         
-        question = Question.query.filter(Question.id == 7).one_or_none()
+        question = Question.query.filter(Question.id == 5).one_or_none()
         
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data["success"], True)
-        self.assertEqual(data["deleted"], 7)
+        self.assertEqual(data["deleted"], 5)
         self.assertTrue(data["total_questions"])
         self.assertTrue(len(data["questions"]))
         self.assertEqual(question, None)
@@ -96,6 +286,74 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data["total_questions"])
         self.assertTrue(len(data["questions"]))
     
+    def test_create_question_updates_totals(self):
+        before = json.loads(self.client().get("/categories/6/questions").data)
+        res = self.client().post("/questions", json={"question": "Who won the 2014 World Cup?", "answer": "Germany", "category": 6, "difficulty": 2})
+        after = json.loads(self.client().get("/categories/6/questions").data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(after["total_questions"], before["total_questions"] + 1)
+        self.assertEqual(after["total_category_questions"], before["total_category_questions"] + 1)
+
+    def test_totals_loaded_during_a_write_count_it_once(self):
+        with self.app.app_context():
+            before = question_counts().total()
+            notify_write(Question.__tablename__, "reset", None)
+            question = Question("Who won the 2014 World Cup?", "Germany", 6, 2)
+            with writing(Question.__tablename__):
+                db.session.add(question)
+                db.session.commit()
+                # A cold load between the commit and the event sees the row
+                self.assertEqual(question_counts().total(), before + 1)
+                notify_write(Question.__tablename__, "insert", question.format())
+
+            self.assertEqual(question_counts().total(), before + 1)
+
+    def test_304_sent_for_unchanged_question_page(self):
+        first = self.client().get("/questions")
+        res = self.client().get("/questions", headers={"If-None-Match": first.headers["ETag"]})
+
+        self.assertEqual(res.status_code, 304)
+
+    def test_question_write_invalidates_cached_page(self):
+        first = self.client().get("/categories/6/questions")
+        self.client().post("/questions", json={"question": "Who won the 2014 World Cup?", "answer": "Germany", "category": 6, "difficulty": 2})
+        res = self.client().get("/categories/6/questions", headers={"If-None-Match": first.headers["ETag"]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers["ETag"], first.headers["ETag"])
+        self.assertEqual(data["total_category_questions"], json.loads(first.data)["total_category_questions"] + 1)
+
+    def test_create_question_compact(self):
+        res = self.client().post("/questions?compact=true", json=self.batch_question)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["created"])
+        self.assertTrue(data["total_questions"])
+        self.assertNotIn("questions", data)
+
+    def test_create_and_delete_questions_batch(self):
+        res = self.client().post("/questions/batch", json={"questions": [self.batch_question, self.batch_question]})
+        created = json.loads(res.data)
+        res = self.client().delete("/questions/batch", json={"ids": created["created"]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(created["created"]), 2)
+        self.assertEqual(data["deleted"], sorted(created["created"]))
+        self.assertEqual(data["total_questions"], created["total_questions"] - 2)
+
+    def test_422_batch_delete_with_unknown_id(self):
+        created = json.loads(self.client().post("/questions/batch", json={"questions": [self.batch_question]}).data)
+        res = self.client().delete("/questions/batch", json={"ids": created["created"] + [100000]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["success"], False)
+        self.assertIsNotNone(Question.query.get(created["created"][0]))
+
     def test_422_question_creation_fails(self):
         res = self.client().post("/questions", json={
             'difficulty': "one"
@@ -106,23 +364,129 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data["success"], False)
         self.assertEqual(data["message"], "unprocessable")
     
+    def test_bulk_import_questions(self):
+        lines = [
+            json.dumps({"question": "Bulk question {}?".format(i), "answer": "Answer {}".format(i), "category": 1, "difficulty": 1})
+            for i in range(25)
+        ]
+        res = self.client().post("/questions/import", data="\n".join(lines), content_type="application/x-ndjson")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["imported"], 25)
+        self.assertTrue(data["total_questions"])
+
+    def test_422_bulk_import_invalid_row(self):
+        res = self.client().post("/questions/import", data='{"question": "No answer?"}', content_type="application/x-ndjson")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["success"], False)
+
+    def test_bulk_export_questions(self):
+        res = self.client().get("/questions/export?format=csv")
+        lines = res.data.decode("utf-8").splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(lines[0], "id,question,answer,category,difficulty")
+        self.assertTrue(len(lines) > 1)
+
     def test_get_question_search_results(self):
-        res = self.client().post("/questions/search", json={"search": "Wha"})
+        res = self.client().post("/questions/search", json={"searchTerm": "Wha"})
         data = json.loads(res.data)
         
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data["success"], True)
         self.assertTrue(data["questions"])
-        self.assertTrue(data["current_category"])
+        self.assertIsNone(data["current_category"])
         self.assertTrue(len(data["questions"]))
     
+    def test_search_uses_migrated_index(self):
+        with self.app.app_context():
+            dialect, backend = db.engine.dialect.name, question_search().backend
+
+        self.assertEqual(backend, {"postgresql": "postgresql", "sqlite": "sqlite"}.get(dialect, "like"))
+
+    def test_search_matches_answer_text(self):
+        res = self.client().post("/questions/search", json={"searchTerm": "Uruguay"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["total_questions"], 1)
+        self.assertEqual(data["questions"][0]["answer"], "Uruguay")
+
+    def test_search_results_are_paginated(self):
+        res = self.client().post("/questions/search", json={"searchTerm": "the"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertLessEqual(len(data["questions"]), 10)
+        self.assertGreaterEqual(data["total_questions"], len(data["questions"]))
+
+    def test_response_cache_evicts_tag_index(self):
+        cache = ResponseCache()
+        with self.app.app_context():
+            for page in range(self.app.config["RESPONSE_CACHE_ENTRIES"] + 100):
+                entry, generations = cache.lookup(("questions", ("page", page)), ("questions",))
+                cache.store(("questions", ("page", page)), ("questions",), generations, [], None)
+
+        self.assertEqual(len(cache), self.app.config["RESPONSE_CACHE_ENTRIES"])
+        self.assertEqual(len(cache._tags["questions"]), len(cache))
+
+    def test_response_cache_drops_page_read_across_clear(self):
+        cache = ResponseCache()
+        key, tags = ("category", 1, ("page", 1)), (("category", 1),)
+        with self.app.app_context():
+            entry, generations = cache.lookup(key, tags)
+            cache.clear()
+            cache.store(key, tags, generations, [], None)
+            entry, generations = cache.lookup(key, tags)
+
+        self.assertIsNone(entry)
+
+    def test_suggest_questions_by_prefix(self):
+        res = self.client().get("/questions/suggest?q=who%20inv")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual([question["question"] for question in data["suggestions"]], ["Who invented Peanut Butter?"])
+        self.assertNotIn("answer", data["suggestions"][0])
+
+    def test_suggest_sees_new_question(self):
+        res = self.client().post("/questions", json=self.batch_question)
+        question_id = json.loads(res.data)["created"]
+        data = json.loads(self.client().get("/questions/suggest?q=which%20team%20won").data)
+
+        self.assertIn(question_id, [question["id"] for question in data["suggestions"]])
+
+    def test_suggest_forgets_deleted_question(self):
+        first = json.loads(self.client().get("/questions/suggest?q=w&limit=1").data)["suggestions"][0]
+        self.client().delete("/questions/{}".format(first["id"]))
+        data = json.loads(self.client().get("/questions/suggest?q=w").data)
+
+        self.assertNotIn(first["id"], [question["id"] for question in data["suggestions"]])
+        self.assertEqual(len(data["suggestions"]), 10)
+
+    def test_suggest_follows_batches(self):
+        first = json.loads(self.client().get("/questions/suggest?q=which%20team").data)["suggestions"]
+        created = json.loads(self.client().post("/questions/batch", json={"questions": [self.batch_question, self.batch_question]}).data)["created"]
+        data = json.loads(self.client().get("/questions/suggest?q=which%20team").data)
+        self.assertEqual(sorted(question["id"] for question in data["suggestions"]), sorted(created + [question["id"] for question in first]))
+
+        self.client().delete("/questions/batch", json={"ids": created})
+        data = json.loads(self.client().get("/questions/suggest?q=which%20team").data)
+        self.assertEqual(data["suggestions"], first)
+
     def test_get_question_search_no_results(self):
-        res = self.client().post("/questions/search/10")
+        res = self.client().post("/questions/search", json={"searchTerm": ""})
         data = json.loads(res.data)
         
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data["success"], False)
-        self.assertEqual(len(data["message"]), "resourse not found")
+        self.assertEqual(data["message"], "resource not found")
     
     def test_get_question_by_category(self):
         res = self.client().get("/categories/1/questions")
@@ -133,6 +497,21 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data["questions"])
         self.assertTrue(len(data["questions"]))
     
+    def test_stream_question_by_category(self):
+        res = self.client().get("/categories/1/questions?stream=true")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(len(data["questions"]), data["total_category_questions"])
+
+    def test_stream_search_results(self):
+        res = self.client().post("/questions/search?stream=true", json={"searchTerm": "what"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data["questions"]), data["total_questions"])
+
     def test_404_sent_requesting_question_by_category(self):
         res = self.client().get("/categories/1000/questions")
         data = json.loads(res.data)
@@ -150,9 +529,116 @@ class TriviaTestCase(unittest.TestCase):
         
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data["success"], True)
-        self.assertTrue(data["questions"])
-        self.assertTrue(len(data["questions"]))
+        self.assertTrue(data["question"])
+        self.assertTrue(data["question"]["id"])
     
+    def test_quiz_never_repeats_previous_questions(self):
+        previous_questions = []
+        while True:
+            res = self.client().post("/quizzes", json={
+                'quiz_category': {'id': 2, 'type': 'Art'},
+                'previous_questions': previous_questions
+            })
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            if data["question"] is None:
+                break
+            self.assertNotIn(data["question"]["id"], previous_questions)
+            self.assertEqual(int(data["question"]["category"]), 2)
+            previous_questions.append(data["question"]["id"])
+
+        self.assertTrue(len(previous_questions))
+
+    def test_quiz_session_serves_each_question_once(self):
+        res = self.client().post("/quizzes/sessions", json={'quiz_category': {'id': 4, 'type': 'History'}})
+        token = json.loads(res.data)["session"]
+
+        served = []
+        while True:
+            data = json.loads(self.client().post("/quizzes/sessions/{}/next".format(token)).data)
+            if data["question"] is None:
+                break
+            served.append(data["question"]["id"])
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(len(served))
+        self.assertEqual(len(served), len(set(served)))
+        self.assertEqual(data["answered"], len(served))
+
+    def test_quiz_difficulty_range(self):
+        previous_questions = []
+        while True:
+            res = self.client().post("/quizzes", json={
+                'quiz_category': {'id': 0, 'type': 'click'},
+                'previous_questions': previous_questions,
+                'quiz_difficulty': {'min': 2, 'max': 3}
+            })
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            if data["question"] is None:
+                break
+            self.assertIn(data["question"]["difficulty"], (2, 3))
+            previous_questions.append(data["question"]["id"])
+
+        with self.app.app_context():
+            expected = Question.query.filter(Question.difficulty.between(2, 3)).count()
+        self.assertEqual(len(previous_questions), expected)
+
+    def test_quiz_session_difficulty(self):
+        res = self.client().post("/quizzes/sessions", json={'quiz_category': {'id': 0, 'type': 'click'}, 'quiz_difficulty': [1]})
+        token = json.loads(res.data)["session"]
+        data = json.loads(self.client().post("/quizzes/sessions/{}/next".format(token)).data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["question"]["difficulty"], 1)
+
+    def test_422_sent_for_invalid_quiz_difficulty(self):
+        res = self.client().post("/quizzes", json={
+            'quiz_category': {'id': 0, 'type': 'click'},
+            'previous_questions': [],
+            'quiz_difficulty': 'hard'
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["success"], False)
+
+    def test_422_sent_for_oversized_quiz_difficulty_range(self):
+        for quiz_difficulty in ({'min': 0, 'max': 10 ** 9}, {'min': 4, 'max': 2}, [1, 6]):
+            res = self.client().post("/quizzes", json={
+                'quiz_category': {'id': 0, 'type': 'click'},
+                'previous_questions': [],
+                'quiz_difficulty': quiz_difficulty
+            })
+
+            self.assertEqual(res.status_code, 422)
+
+    def test_422_sent_for_too_many_previous_questions(self):
+        res = self.client().post("/quizzes", json={
+            'quiz_category': {'id': 0, 'type': 'click'},
+            'previous_questions': list(range(self.app.config["QUIZ_MAX_PREVIOUS_QUESTIONS"] + 1))
+        })
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_seen_set_stays_small_for_sparse_ids(self):
+        sparse = SeenSet([7, 500000, 1000000])
+        dense = SeenSet(range(1, 1001))
+
+        self.assertEqual(sorted(sparse), [7, 500000, 1000000])
+        self.assertIsNone(sparse._bits)
+        self.assertLessEqual(len(dense._bits), 126)
+        self.assertTrue(all(question_id in dense for question_id in range(1, 1001)))
+        self.assertNotIn(1001, dense)
+
+    def test_404_sent_for_unknown_quiz_session(self):
+        res = self.client().post("/quizzes/sessions/not-a-session/next")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "resource not found")
+
     def test_404_sent_requesting_quiz_question(self):
         res = self.client().post("/quizzes", json={
             'quiz_category': {'id': 1000, 'type': 'click'},
@@ -165,6 +651,205 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data["message"], "unprocessable")
 
 
+class AdmissionControlTestCase(DatabaseTestCase):
+    """This class checks the rate and concurrency limits"""
+    test_config = {
+        "RATE_LIMITS": {"get_quiz": (0.01, 2), "get_questions:stream": (0.01, 1), "create_question:search": (0.01, 1)},
+        "CONCURRENCY_LIMITS": {"search_questions": 1},
+    }
+
+    def post_quiz(self, client="10.0.0.1"):
+        return self.client().post("/quizzes", json={
+            'quiz_category': {'id': 0, 'type': 'click'},
+            'previous_questions': []
+        }, environ_base={"REMOTE_ADDR": client})
+
+    def test_429_sent_over_rate_limit(self):
+        responses = [self.post_quiz() for _ in range(3)]
+        data = json.loads(responses[2].data)
+
+        self.assertEqual([res.status_code for res in responses], [200, 200, 429])
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["message"], "too many requests")
+        self.assertGreaterEqual(int(responses[2].headers["Retry-After"]), 1)
+        self.assertEqual(self.post_quiz(client="10.0.0.2").status_code, 200)
+
+    def test_streams_and_search_limited_apart_from_pages(self):
+        streams = [self.client().get("/questions?stream=true") for _ in range(2)]
+        searches = [self.client().post("/questions", json={"search": "title"}) for _ in range(2)]
+        page = self.client().get("/questions")
+
+        self.assertEqual([res.status_code for res in streams], [200, 429])
+        self.assertEqual([res.status_code for res in searches], [200, 429])
+        self.assertEqual(page.status_code, 200)
+
+    def test_429_sent_over_concurrency_limit(self):
+        admission = self.app.extensions["admission_control"]
+        with self.app.app_context():
+            holds_slot, wait = admission.admit("search_questions", "10.0.0.3")
+        busy = self.client().post("/questions/search", json={"searchTerm": "title"})
+        admission.release("search_questions")
+        res = self.client().post("/questions/search", json={"searchTerm": "title"})
+
+        self.assertTrue(holds_slot)
+        self.assertEqual(busy.status_code, 429)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('trivia_requests_rejected_total{endpoint="search_questions",limit="concurrency"} 1', self.client().get("/metrics").data.decode("utf-8"))
+
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    """This class checks read routing between a primary and a replica SQLite file"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(self.directory, "primary.db"),
+            "REPLICA_DATABASE_URLS": ["sqlite:///" + os.path.join(self.directory, "replica.db")],
+            "RESPONSE_CACHE": False,
+        })
+        self.client = self.app.test_client
+        with self.app.app_context():
+            for bind in (None, "replica_0"):
+                engine = db.get_engine(self.app, bind=bind)
+                db.Model.metadata.create_all(engine)
+                engine.execute(Category.__table__.insert(), type="Science")
+                engine.execute(Question.__table__.insert(), question="Where do I live?", answer=bind or "primary", category=1, difficulty=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_reads_go_to_replica(self):
+        data = json.loads(self.client().get("/questions").data)
+
+        self.assertEqual(data["questions"][0]["answer"], "replica_0")
+
+    def test_client_reads_own_write_from_primary(self):
+        client = self.client()
+        res = client.post("/questions?compact=true", json={"question": "Who wrote this?", "answer": "Me", "category": 1, "difficulty": 1})
+        data = json.loads(client.get("/questions").data)
+
+        self.assertIn("trivia_primary_until=", res.headers["Set-Cookie"])
+        self.assertEqual(data["questions"][0]["answer"], "primary")
+        self.assertEqual(data["questions"][1]["answer"], "Me")
+
+
+class CacheBusTestCase(unittest.TestCase):
+    """This class checks that writes through one worker reach the caches of another"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_url = "memory://" + self.id()
+        test_config = {
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(self.directory, "trivia.db"),
+            "CACHE_URL": self.cache_url,
+            "RATE_LIMIT": False,
+        }
+        self.writer = create_app(test_config)
+        self.reader = create_app(test_config)
+        create_test_database(self.writer)
+
+    def tearDown(self):
+        brokers.pop(self.cache_url, None)
+        shutil.rmtree(self.directory)
+
+    def test_write_reaches_other_worker(self):
+        reader = self.reader.test_client()
+        before = json.loads(reader.get("/categories/6/questions").data)
+        res = self.writer.test_client().post("/questions", json={"question": "Which animal is a zebra?", "answer": "A horse", "category": 6, "difficulty": 5})
+        after = json.loads(reader.get("/categories/6/questions").data)
+        suggestions = json.loads(reader.get("/questions/suggest?q=zebra").data)["suggestions"]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(after["total_questions"], before["total_questions"] + 1)
+        self.assertEqual([question["id"] for question in suggestions], [json.loads(res.data)["created"]])
+
+    def test_missed_write_resets_other_worker(self):
+        reader = self.reader.test_client()
+        before = json.loads(reader.get("/questions").data)["total_questions"]
+        with self.writer.app_context():
+            # Written behind the bus's back, as if the message were lost
+            engine = db.get_engine(self.writer)
+            engine.execute(Question.__table__.insert(), question="Which animal is a zebra?", answer="A horse", category=6, difficulty=5)
+        brokers[self.cache_url].incr(VERSION_KEY.format(Question.__tablename__))
+        self.reader.extensions["cache_bus"]._checked_at = 0.0
+
+        self.assertEqual(json.loads(reader.get("/questions").data)["total_questions"], before + 1)
+
+
+@unittest.skipIf(databases is None, "async serving mode not installed")
+class AsyncTriviaTestCase(unittest.TestCase):
+    """This class runs the async (ASGI) serving mode against the Flask app"""
+
+    @classmethod
+    def setUpClass(cls):
+        # A file both the Flask app and the async driver can open; the tests only read
+        cls.directory = tempfile.mkdtemp()
+        cls.test_config = {"SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(cls.directory, "trivia.db")}
+        cls.app = create_app(cls.test_config)
+        create_test_database(cls.app)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        from starlette.testclient import TestClient
+        self.asgi = create_asgi_app(self.test_config)
+        self.client = TestClient(self.asgi)
+        self.client.__enter__()
+
+    def tearDown(self):
+        self.client.__exit__(None, None, None)
+
+    def test_async_listing_matches_flask(self):
+        flask_client = self.app.test_client()
+        for path in ("/questions", "/questions?page=2", "/categories/1/questions"):
+            res = self.client.get(path)
+            expected = flask_client.get(path)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.json(), json.loads(expected.data))
+            self.assertEqual(res.headers["ETag"], expected.headers["ETag"])
+
+    def test_async_listing_after_reset(self):
+        expected = json.loads(self.app.test_client().get("/categories/1/questions").data)
+        with self.app.app_context():
+            # The caches reload in the thread pool, off the event loop
+            notify_write(Question.__tablename__, "reset", None)
+            notify_write(Category.__tablename__, "reset", None)
+        res = self.client.get("/categories/1/questions")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json(), expected)
+
+    def test_async_400_sent_for_out_of_range_cursor_or_page(self):
+        for path in ("/questions", "/categories/1/questions"):
+            self.assertEqual(self.client.get(path + "?cursor=" + encode_cursor(10 ** 23)).status_code, 400)
+            self.assertEqual(self.client.get(path + "?page=" + str(10 ** 20)).status_code, 400)
+
+    def test_async_suggest(self):
+        res = self.client.get("/questions/suggest?q=peanut")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()["suggestions"][0]["id"], 12)
+
+    def test_async_quiz_session(self):
+        session = self.client.post("/quizzes/sessions", json={"quiz_category": {"id": 0}}).json()
+        res = self.client.post("/quizzes/sessions/{}/next".format(session["session"]))
+        data = res.json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["question"])
+        self.assertEqual(data["answered"], 1)
+        self.assertEqual(self.client.delete("/quizzes/sessions/" + session["session"]).json()["answered"], 1)
+
+    def test_async_404_sent_for_unknown_quiz_session(self):
+        res = self.client.post("/quizzes/sessions/unknown/next")
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(res.json(), {"success": False, "error": 404, "message": "resource not found"})
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file